@@ -1,34 +1,74 @@
+import argparse
+import glob
+import json
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import pandas as pd
 import plotly.graph_objects as go
 import numpy as np
-import chardet
 
-# Function to detect file encoding
-def detect_encoding(file_path):
-    with open(file_path, 'rb') as file:
-        result = chardet.detect(file.read(100000))  # Read the first 100000 bytes for detection
-        return result['encoding']
+# The shared export loader lives in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from exports import read_export
+from massindex import MassIndex
 
 # File path to the CSV
 file_path = '/Users/matias/Library/Mobile Documents/com~apple~CloudDocs/Work/LiverF/LiverF.csv'
 
-# Detect the encoding of the CSV file
-encoding = detect_encoding(file_path)
+# Output HTML file
+output_html = 'volcano_plot.html'
+
+# Output mode: 'html' writes one self-contained figure, 'lazy' writes a viewer with per-experiment data files into LAZY_OUTPUT_DIR
+OUTPUT_MODE = 'html'
+LAZY_OUTPUT_DIR = 'volcano_data'
+
+# Viewer page copied into LAZY_OUTPUT_DIR; it fetches an experiment's data only when it is selected
+VIEWER_TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'volcano_viewer.html')
+
+# Number of masses highlighted in gold
+GOLD_COUNT = 50
+
+# Ranking whose first GOLD_COUNT masses are highlighted (e.g. by_distance_named.csv from calcDistOutlier.py); None uses the export's own first masses
+GOLD_SOURCE = None
+
+# Tolerance for matching the gold masses of a GOLD_SOURCE to the export, in ppm and/or mDa, plus an optional retention time window in minutes
+GOLD_PPM = 5.0
+GOLD_MDA = None
+GOLD_RT_WINDOW = None
+
+# Draw the points with WebGL ('webgl', go.Scattergl) or SVG ('svg', go.Scatter); WebGL stays fast with tens of thousands of points
+RENDER_MODE = 'webgl'
+
+# Thin out the insignificant (blue) points to at most DECIMATE_PER_CELL per cell of a DECIMATE_GRID x DECIMATE_GRID grid;
+# significant and gold points are always kept
+DECIMATE = False
+DECIMATE_GRID = 200
+DECIMATE_PER_CELL = 4
+
+# How plotly.js is included: True inlines it (~3.5 MB per file), 'directory' references a plotly.min.js next to the HTML
+INCLUDE_PLOTLYJS = True
 
-# Load the CSV file using the detected encoding
-by_distance_named = pd.read_csv(file_path, encoding=encoding)
+# Colours of the points, indexed by the colour codes of each experiment
+COLOR_PALETTE = np.array(['blue', 'green', 'red', 'gold'], dtype=object)
+BLUE, GREEN, RED, GOLD = range(len(COLOR_PALETTE))
 
-# Ensure 'Calc. MW' is numeric
-by_distance_named['Calc. MW'] = pd.to_numeric(by_distance_named['Calc. MW'], errors='coerce')
+# Function to load an export using the detected encoding (both are cached between runs)
+def load_data(file_path):
+    by_distance_named = read_export(file_path, encoding=None)
 
-# Extract the list of Calc. MW to be highlighted in gold (ensure only 50 masses)
-gold_masses = by_distance_named['Calc. MW'].dropna().head(50).tolist()
+    # Ensure 'Calc. MW' is numeric
+    by_distance_named['Calc. MW'] = pd.to_numeric(by_distance_named['Calc. MW'], errors='coerce')
+    return by_distance_named
 
 # Function to automatically detect fold change and p-value columns
 def detect_columns(dataframe):
     fold_change_columns = [col for col in dataframe.columns if col.startswith('Log2 Fold Change:')]
     p_value_columns = [col for col in dataframe.columns if col.startswith('P-value:')]
-    
+
     # Pair the detected columns based on matching experiment names after the prefixes
     detected_columns = {}
     for fc_col in fold_change_columns:
@@ -42,71 +82,102 @@ def detect_columns(dataframe):
                 }
     return detected_columns
 
-# Automatically detect the columns and their titles
-files_and_columns = detect_columns(by_distance_named)
-
-# Initialize the figure
-fig = go.Figure()
-
-# List to store per-experiment data
-experiments_data = []
-
-# Track the traces and buttons for the dropdown
-dropdown_buttons = []
-for i, (experiment, params) in enumerate(files_and_columns.items()):
-    # Use the data from 'by_distance_named' directly
-    data = by_distance_named.copy()
-    
-    # Ensure necessary columns exist, and replace NaN with empty strings
-    data['Name'] = data['Name'].fillna('[-]')
-    data['Formula'] = data['Formula'].fillna('[-]')
-    data['Calc. MW'] = pd.to_numeric(data['Calc. MW'], errors='coerce')
-    data['m/z'] = data['m/z'].fillna('')
-    data['RT [min]'] = data['RT [min]'].fillna('')
-    
-    # Convert fold change and p-value columns to numeric
-    data[params['fold_change_col']] = pd.to_numeric(data[params['fold_change_col']], errors='coerce')
-    data[params['p_value_col']] = pd.to_numeric(data[params['p_value_col']], errors='coerce')
-    
-    # Drop rows with NaN values in fold change or p-value columns
-    data = data.dropna(subset=[params['fold_change_col'], params['p_value_col']])
-    
-    # Create a new column for -log10(P-value)
-    data['-Log10(P-value)'] = -np.log10(data[params['p_value_col']])
-    
-    # Determine conditions for coloring points
-    significant_upregulated = (data[params['fold_change_col']] > 0.5) & (data[params['p_value_col']] < 0.05)
-    significant_downregulated = (data[params['fold_change_col']] < -0.5) & (data[params['p_value_col']] < 0.05)
-    
-    # Create a color column
-    data['Color'] = 'blue'  # Default color
-    data.loc[significant_upregulated, 'Color'] = 'green'
-    data.loc[significant_downregulated, 'Color'] = 'red'
-    data.loc[data['Calc. MW'].isin(gold_masses), 'Color'] = 'gold'  # Gold color for specific masses
-    
-    # Modify hovertext to include the additional columns
+# Function to load the masses (and retention times, if the file has them) to highlight in gold
+def load_gold(by_distance_named, gold_source=GOLD_SOURCE):
+    ranking = by_distance_named if gold_source is None else read_export(gold_source, encoding=None)
+    ranking = ranking[pd.to_numeric(ranking['Calc. MW'], errors='coerce').notna()].head(GOLD_COUNT)
+    retention_times = ranking['RT [min]'] if 'RT [min]' in ranking.columns else None
+    return ranking['Calc. MW'], retention_times
+
+# Function to build what every experiment shares, once: the hover text and the gold mask of all rows
+def build_shared(by_distance_named, gold_source=GOLD_SOURCE):
+    gold_masses, gold_retention_times = load_gold(by_distance_named, gold_source)
+    if gold_source is None:
+        # The masses come from this export itself, so only exact matches are gold; a tolerance would add near-isobars
+        gold = by_distance_named['Calc. MW'].isin(gold_masses).to_numpy()
+    else:
+        # Match the gold masses within a tolerance, so masses rounded differently in another file are still found
+        rt_window = GOLD_RT_WINDOW if gold_retention_times is not None and 'RT [min]' in by_distance_named.columns else None
+        mass_index = MassIndex(by_distance_named['Calc. MW'], by_distance_named['RT [min]'] if rt_window is not None else None)
+        gold = mass_index.contains(gold_masses, ppm=GOLD_PPM, mda=GOLD_MDA, query_retention_times=gold_retention_times, rt_window=rt_window)
+
+    # Hovertext including the additional columns, with missing values replaced
     hover_text = (
-        "Name:\t" + data['Name'].astype(str) + "<br>" +
-        "Formula:\t" + data['Formula'].astype(str) + "<br>" +
-        "Calc. MW:\t" + data['Calc. MW'].astype(str) + "<br>" +
-        "m/z:\t" + data['m/z'].astype(str) + "<br>" +
-        "RT [min]:\t" + data['RT [min]'].astype(str)
+        "Name:\t" + by_distance_named['Name'].fillna('[-]').astype(str) + "<br>" +
+        "Formula:\t" + by_distance_named['Formula'].fillna('[-]').astype(str) + "<br>" +
+        "Calc. MW:\t" + by_distance_named['Calc. MW'].astype(str) + "<br>" +
+        "m/z:\t" + by_distance_named['m/z'].fillna('').astype(str) + "<br>" +
+        "RT [min]:\t" + by_distance_named['RT [min]'].fillna('').astype(str)
     )
-    
+
+    return {
+        'hover_text': hover_text.to_numpy(),
+        'gold': gold
+    }
+
+# Function to compute the points of one experiment: fold change, -log10(p-value), colour codes and the rows they come from
+def build_experiment(by_distance_named, params, shared):
+    fold_change = pd.to_numeric(by_distance_named[params['fold_change_col']], errors='coerce').to_numpy()
+    p_value = pd.to_numeric(by_distance_named[params['p_value_col']], errors='coerce').to_numpy()
+
+    # Skip rows with NaN values in fold change or p-value columns
+    rows = np.flatnonzero(~(np.isnan(fold_change) | np.isnan(p_value)))
+    x = fold_change[rows]
+    p_value = p_value[rows]
+    y = -np.log10(p_value)
+
+    # Determine conditions for coloring points; gold takes precedence
+    codes = np.full(len(rows), BLUE, dtype=np.uint8)
+    codes[(x > 0.5) & (p_value < 0.05)] = GREEN
+    codes[(x < -0.5) & (p_value < 0.05)] = RED
+    codes[shared['gold'][rows]] = GOLD
+
+    return {'rows': rows, 'x': x, 'y': y, 'codes': codes}
+
+# Function to keep every significant and gold point but only a few insignificant points per grid cell
+def decimate_points(points, grid=DECIMATE_GRID, per_cell=DECIMATE_PER_CELL):
+    x, y = points['x'], points['y']
+    # Points off the chart (infinite fold change or p-value of 0) are never dropped
+    blue = np.flatnonzero((points['codes'] == BLUE) & np.isfinite(x) & np.isfinite(y))
+    if len(blue) == 0:
+        return points
+
+    # Grid cell of every blue point over the range of the blue cloud
+    cells = np.zeros(len(blue), dtype=np.int64)
+    for values in (x[blue], y[blue]):
+        low, high = values.min(), values.max()
+        scale = grid / (high - low) if high > low else 0
+        cells = cells * grid + np.minimum(((values - low) * scale).astype(np.int64), grid - 1)
+
+    # Rank of every point within its cell, in row order
+    order = np.argsort(cells, kind='stable')
+    sorted_cells = cells[order]
+    starts = np.flatnonzero(np.r_[True, sorted_cells[1:] != sorted_cells[:-1]])
+    ranks = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+
+    keep = np.ones(len(x), dtype=bool)
+    keep[blue[order[ranks >= per_cell]]] = False
+    return {key: values[keep] for key, values in points.items()}
+
+# Function to compute the axis ranges and threshold lines of one experiment
+def experiment_layout(points):
+    # A comparison without any row holding both values has no range; NaN leaves the axes to plotly, as empty columns always did
+    if len(points['x']) == 0:
+        points = {'x': np.array([np.nan]), 'y': np.array([np.nan])}
+
     # Compute maximum absolute fold change value
-    max_abs_x = data[params['fold_change_col']].abs().max()
+    max_abs_x = np.abs(points['x']).max()
     # Extend it by 10%
     max_x = max_abs_x * 1.1
     # Set symmetric x-axis limits
     x_min = -max_x
     x_max = max_x
-    
+
     # Compute y-axis limits
-    y_values = data['-Log10(P-value)']
-    y_max = y_values.max()
+    y_max = points['y'].max()
     y_range = y_max
     y_max += 0.1 * y_range  # Extend y_max by 10%
-    
+
     # Create shapes
     shapes = [
         # Horizontal line at y = -log10(0.05)
@@ -139,120 +210,311 @@ for i, (experiment, params) in enumerate(files_and_columns.items()):
             line=dict(color="Black", dash="dash")
         )
     ]
-    
-    # Append experiment data to the list
-    experiments_data.append({
+
+    return {
         'x_min': x_min,
         'x_max': x_max,
         'y_max': y_max,
         'shapes': shapes
-    })
-    
-    fig.add_trace(go.Scatter(
-        x=data[params['fold_change_col']],
-        y=data['-Log10(P-value)'],
-        mode='markers',
-        marker=dict(color=data['Color'], opacity=0.9),
-        hovertext=hover_text,
-        hoverinfo='text',
-        visible=True if i == 0 else False,  # Make the first plot visible
-        name="Key",
-        hoverlabel=dict(
-            font_size=16,
-            font_family="Arial",
-            bgcolor="red",
-            bordercolor="black",
+    }
+
+# Trace class of a render mode
+def scatter_class(render_mode):
+    if render_mode not in ('webgl', 'svg'):
+        raise ValueError(f"Unknown render mode: {render_mode}")
+    return go.Scattergl if render_mode == 'webgl' else go.Scatter
+
+# Function to build the volcano figure with one trace per experiment and a dropdown to switch between them
+def build_figure(by_distance_named, render_mode=RENDER_MODE, decimate=DECIMATE, gold_source=GOLD_SOURCE):
+    # Automatically detect the columns and their titles
+    files_and_columns = detect_columns(by_distance_named)
+    shared = build_shared(by_distance_named, gold_source)
+
+    # Initialize the figure
+    fig = go.Figure()
+
+    # List to store per-experiment data
+    experiments_data = []
+
+    # Track the traces and buttons for the dropdown
+    dropdown_buttons = []
+    for i, (experiment, params) in enumerate(files_and_columns.items()):
+        points = build_experiment(by_distance_named, params, shared)
+        # The axes always cover every point, decimated or not
+        layout = experiment_layout(points)
+        experiments_data.append(layout)
+        if decimate:
+            points = decimate_points(points)
+
+        fig.add_trace(scatter_class(render_mode)(
+            x=points['x'],
+            y=points['y'],
+            mode='markers',
+            marker=dict(color=COLOR_PALETTE[points['codes']], opacity=0.9),
+            hovertext=shared['hover_text'][points['rows']],
+            hoverinfo='text',
+            visible=True if i == 0 else False,  # Make the first plot visible
+            name="Key",
+            hoverlabel=dict(
+                font_size=16,
+                font_family="Arial",
+                bgcolor="red",
+                bordercolor="black",
+            )
+        ))
+
+        # Add dropdown button for this dataset
+        dropdown_buttons.append(dict(
+            method="update",
+            label=params['title'],
+            args=[
+                {"visible": [j == i for j in range(len(files_and_columns))] + [True] * 4},  # Keep legend visible
+                {"title": params['title'],
+                 "xaxis": {"title": params['fold_change_col'], "range": [layout['x_min'], layout['x_max']]},
+                 "yaxis": {"title": f"-Log10({params['p_value_col']})", "range": [0, layout['y_max']]},
+                 "shapes": layout['shapes']}
+            ]
+        ))
+
+    # Add key for the colors (gold, green, red, blue)
+    color_legend = [
+        go.Scatter(
+            x=[None], y=[None],
+            mode='markers',
+            marker=dict(size=12, color='gold'),
+            showlegend=True,
+            name='50 Lowest Average Distances',
+            visible=True
+        ),
+        go.Scatter(
+            x=[None], y=[None],
+            mode='markers',
+            marker=dict(size=12, color='green'),
+            showlegend=True,
+            name='Significant Upregulated',
+            visible=True
+        ),
+        go.Scatter(
+            x=[None], y=[None],
+            mode='markers',
+            marker=dict(size=12, color='red'),
+            showlegend=True,
+            name='Significant Downregulated',
+            visible=True
+        ),
+        go.Scatter(
+            x=[None], y=[None],
+            mode='markers',
+            marker=dict(size=12, color='blue'),
+            showlegend=True,
+            name='Insignificant',
+            visible=True
         )
-    ))
-    
-    # Add dropdown button for this dataset
-    dropdown_buttons.append(dict(
-        method="update",
-        label=params['title'],
-        args=[
-            {"visible": [j == i for j in range(len(files_and_columns))] + [True] * 4},  # Keep legend visible
-            {"title": params['title'],
-             "xaxis": {"title": params['fold_change_col'], "range": [x_min, x_max]},
-             "yaxis": {"title": f"-Log10({params['p_value_col']})", "range": [0, y_max]},
-             "shapes": shapes}
+    ]
+
+    # Add the color legend to the figure
+    for legend_trace in color_legend:
+        fig.add_trace(legend_trace)
+
+    # Add dropdown menu to layout
+    fig.update_layout(
+        updatemenus=[
+            dict(
+                buttons=dropdown_buttons,
+                direction="down",
+                pad={"r": 10, "t": 10},
+                showactive=True,
+                x=1.15,
+                xanchor="right",
+                y=1.15,
+                yanchor="top"
+            )
         ]
-    ))
-
-# Add key for the colors (gold, green, red, blue)
-color_legend = [
-    go.Scatter(
-        x=[None], y=[None],
-        mode='markers',
-        marker=dict(size=12, color='gold'),
-        showlegend=True,
-        name='50 Lowest Average Distances',
-        visible=True
-    ),
-    go.Scatter(
-        x=[None], y=[None],
-        mode='markers',
-        marker=dict(size=12, color='green'),
-        showlegend=True,
-        name='Significant Upregulated',
-        visible=True
-    ),
-    go.Scatter(
-        x=[None], y=[None],
-        mode='markers',
-        marker=dict(size=12, color='red'),
-        showlegend=True,
-        name='Significant Downregulated',
-        visible=True
-    ),
-    go.Scatter(
-        x=[None], y=[None],
-        mode='markers',
-        marker=dict(size=12, color='blue'),
-        showlegend=True,
-        name='Insignificant',
-        visible=True
     )
-]
 
-# Add the color legend to the figure
-for legend_trace in color_legend:
-    fig.add_trace(legend_trace)
+    # Set initial layout for the plot
+    initial_experiment = list(files_and_columns.keys())[0]
+    initial_data = experiments_data[0]
 
-# Add dropdown menu to layout
-fig.update_layout(
-    updatemenus=[
-        dict(
-            buttons=dropdown_buttons,
-            direction="down",
-            pad={"r": 10, "t": 10},
-            showactive=True,
-            x=1.15,
-            xanchor="right",
-            y=1.15,
-            yanchor="top"
-        )
-    ]
-)
-
-# Set initial layout for the plot
-initial_experiment = list(files_and_columns.keys())[0]
-initial_data = experiments_data[0]
-
-fig.update_layout(
-    title=files_and_columns[initial_experiment]['title'],
-    xaxis_title=files_and_columns[initial_experiment]['fold_change_col'],
-    yaxis_title=f"-Log10({files_and_columns[initial_experiment]['p_value_col']})",
-    xaxis=dict(range=[initial_data['x_min'], initial_data['x_max']]),
-    yaxis=dict(range=[0, initial_data['y_max']]),
-    shapes=initial_data['shapes'],
-    plot_bgcolor="lightslategray",
-    paper_bgcolor="lightslategray",
-    font=dict(color="black")
-)
-
-# Enable grid lines
-fig.update_xaxes(showgrid=True)
-fig.update_yaxes(showgrid=True)
-
-# Save the plot as an HTML file
-fig.write_html("volcano_plot.html")
+    fig.update_layout(
+        title=files_and_columns[initial_experiment]['title'],
+        xaxis_title=files_and_columns[initial_experiment]['fold_change_col'],
+        yaxis_title=f"-Log10({files_and_columns[initial_experiment]['p_value_col']})",
+        xaxis=dict(range=[initial_data['x_min'], initial_data['x_max']]),
+        yaxis=dict(range=[0, initial_data['y_max']]),
+        shapes=initial_data['shapes'],
+        plot_bgcolor="lightslategray",
+        paper_bgcolor="lightslategray",
+        font=dict(color="black")
+    )
+
+    # Enable grid lines
+    fig.update_xaxes(showgrid=True)
+    fig.update_yaxes(showgrid=True)
+    return fig
+
+# Replace the infinite or missing values JSON cannot hold with None, recursively
+def json_safe(value):
+    if isinstance(value, dict):
+        return {key: json_safe(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [json_safe(item) for item in value]
+    if isinstance(value, (float, np.floating)):
+        return float(value) if np.isfinite(value) else None
+    return value
+
+# Function to write the viewer, a manifest, the shared hover text and one binary data file per experiment
+def write_lazy_output(by_distance_named, output_dir, decimate=DECIMATE, gold_source=GOLD_SOURCE):
+    os.makedirs(output_dir, exist_ok=True)
+    files_and_columns = detect_columns(by_distance_named)
+    shared = build_shared(by_distance_named, gold_source)
+
+    # Hover text of every row, shared by all experiments and fetched once
+    with open(os.path.join(output_dir, 'hover.json'), 'w') as file:
+        json.dump(shared['hover_text'].tolist(), file, separators=(',', ':'))
+
+    experiments = []
+    for i, (experiment, params) in enumerate(files_and_columns.items()):
+        points = build_experiment(by_distance_named, params, shared)
+        layout = experiment_layout(points)
+        if decimate:
+            points = decimate_points(points)
+
+        # Little-endian float32 x, float32 y, uint32 rows and uint8 colour codes, back to back
+        data_file = f'experiment_{i}.bin'
+        with open(os.path.join(output_dir, data_file), 'wb') as file:
+            for values, dtype in ((points['x'], '<f4'), (points['y'], '<f4'), (points['rows'], '<u4'), (points['codes'], 'u1')):
+                file.write(values.astype(dtype).tobytes())
+
+        experiments.append({
+            'title': params['title'],
+            'fold_change_col': params['fold_change_col'],
+            'p_value_col': params['p_value_col'],
+            'count': len(points['x']),
+            'file': data_file,
+            **layout
+        })
+
+    manifest = {'palette': COLOR_PALETTE.tolist(), 'hover': 'hover.json', 'experiments': experiments}
+    with open(os.path.join(output_dir, 'manifest.json'), 'w') as file:
+        json.dump(json_safe(manifest), file, separators=(',', ':'))
+
+    # The viewer and a local plotly.js bundle, so the folder works offline
+    shutil.copyfile(VIEWER_TEMPLATE, os.path.join(output_dir, 'index.html'))
+    plotlyjs_path = os.path.join(output_dir, 'plotly.min.js')
+    if not os.path.exists(plotlyjs_path):
+        from plotly.offline import get_plotlyjs
+        with open(plotlyjs_path, 'w', encoding='utf-8') as file:
+            file.write(get_plotlyjs())
+    return manifest
+
+# Function to write the report of one export, as a single HTML file or as a lazy viewer folder
+def write_report(input_path, output_path, output_mode=OUTPUT_MODE, render_mode=RENDER_MODE, decimate=DECIMATE,
+                 include_plotlyjs=INCLUDE_PLOTLYJS, gold_source=GOLD_SOURCE):
+    by_distance_named = load_data(input_path)
+    if output_mode == 'lazy':
+        # Serve the folder over HTTP (e.g. python -m http.server) since browsers block fetch() from file:// pages
+        write_lazy_output(by_distance_named, output_path, decimate, gold_source)
+    else:
+        fig = build_figure(by_distance_named, render_mode, decimate, gold_source)
+
+        # Save the plot as an HTML file
+        fig.write_html(output_path, include_plotlyjs=include_plotlyjs)
+
+# Batch job run in a worker process; returns the seconds it took
+def run_job(input_path, output_path, options):
+    start = time.perf_counter()
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    write_report(input_path, output_path, **options)
+    return time.perf_counter() - start
+
+# Function to read a manifest: one export per line, optionally followed by a comma and its output path
+def read_manifest(manifest_path):
+    base = os.path.dirname(os.path.abspath(manifest_path))
+    jobs = []
+    with open(manifest_path) as file:
+        for line in file:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            input_path, _, output_path = (part.strip() for part in line.partition(','))
+            jobs.append((os.path.join(base, input_path), os.path.join(base, output_path) if output_path else None))
+    return jobs
+
+# Default output of an export: <name>_volcano.html (or the <name>_volcano folder in lazy mode), in output_dir or next to the export
+def default_output(input_path, output_dir, output_mode):
+    name = os.path.splitext(os.path.basename(input_path))[0] + '_volcano' + ('' if output_mode == 'lazy' else '.html')
+    return os.path.join(output_dir or os.path.dirname(os.path.abspath(input_path)), name)
+
+# An output is up to date if it is newer than its export and the gold ranking
+def is_up_to_date(input_path, output_path, output_mode, gold_source):
+    target = os.path.join(output_path, 'manifest.json') if output_mode == 'lazy' else output_path
+    if not os.path.exists(target):
+        return False
+    sources = [input_path] + ([gold_source] if gold_source is not None else [])
+    return os.path.getmtime(target) >= max(os.path.getmtime(source) for source in sources)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build volcano plot reports for one or many exports.")
+    parser.add_argument('inputs', nargs='*', help="export paths or glob patterns (default: the file_path set in this script)")
+    parser.add_argument('--manifest', help="file listing one export per line, optionally followed by ',<output path>'")
+    parser.add_argument('--output-dir', help="directory for the reports (default: next to each export)")
+    parser.add_argument('--workers', type=int, default=None, help="number of worker processes (default: one per CPU)")
+    parser.add_argument('--force', action='store_true', help="rebuild reports that are newer than their export")
+    parser.add_argument('--lazy', action='store_true', help="write lazy viewer folders instead of single HTML files")
+    parser.add_argument('--render-mode', choices=['webgl', 'svg'], default=RENDER_MODE)
+    parser.add_argument('--decimate', action='store_true', default=DECIMATE, help="thin out the insignificant points")
+    parser.add_argument('--shared-plotlyjs', action='store_true', help="reference a plotly.min.js next to the reports instead of inlining it")
+    parser.add_argument('--gold-source', default=GOLD_SOURCE, help="ranking CSV whose first masses are highlighted in gold")
+    args = parser.parse_args(argv)
+
+    options = {
+        'output_mode': 'lazy' if args.lazy else OUTPUT_MODE,
+        'render_mode': args.render_mode,
+        'decimate': args.decimate,
+        'include_plotlyjs': 'directory' if args.shared_plotlyjs else INCLUDE_PLOTLYJS,
+        'gold_source': args.gold_source
+    }
+
+    # Without inputs, build the single report configured at the top of this script
+    if not args.inputs and not args.manifest:
+        write_report(file_path, LAZY_OUTPUT_DIR if options['output_mode'] == 'lazy' else output_html, **options)
+        return 0
+
+    jobs = read_manifest(args.manifest) if args.manifest else []
+    for pattern in args.inputs:
+        matches = sorted(glob.glob(pattern, recursive=True))
+        if not matches:
+            print(f"No exports match {pattern}")
+        jobs.extend((match, None) for match in matches)
+    jobs = [(input_path, output_path or default_output(input_path, args.output_dir, options['output_mode'])) for input_path, output_path in jobs]
+
+    pending = []
+    for input_path, output_path in jobs:
+        if not args.force and is_up_to_date(input_path, output_path, options['output_mode'], options['gold_source']):
+            print(f"Up to date: {output_path}")
+        else:
+            pending.append((input_path, output_path))
+
+    # Every worker reads through the shared export cache, so a file parsed by one job or an earlier run is not parsed again
+    failures = 0
+    start = time.perf_counter()
+    max_workers = args.workers or min(len(pending), os.cpu_count() or 1) or 1
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(run_job, input_path, output_path, options): (input_path, output_path) for input_path, output_path in pending}
+        for future in as_completed(futures):
+            input_path, output_path = futures[future]
+            try:
+                seconds = future.result()
+            except Exception as error:
+                failures += 1
+                print(f"Failed: {input_path}: {error}")
+            else:
+                print(f"{seconds:8.2f}s  {input_path} -> {output_path}")
+
+    print(f"Built {len(pending) - failures} of {len(jobs)} reports in {time.perf_counter() - start:.2f}s "
+          f"({len(jobs) - len(pending)} up to date, {failures} failed)")
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
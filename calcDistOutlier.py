@@ -1,6 +1,13 @@
+import hashlib
+import json
+import os
 import pandas as pd
 import numpy as np
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+from exports import check_fingerprint, export_rows, file_fingerprint, load_exports, read_export
 
 # List of file names
 files = [
@@ -10,9 +17,17 @@ files = [
 
 REMOVE_OUTLIER = False
 
-# Initialize a dictionary to store the cumulative distances for each compound
-compound_distances = defaultdict(list)
-outlier_detected_files = defaultdict(list)
+# Optional resampling of the ranking: None, 'bootstrap' or 'permutation'
+RESAMPLE_MODE = None
+N_RESAMPLES = 10000
+RESAMPLE_SEED = None
+RESAMPLE_WORKERS = None  # Defaults to one process per core
+
+# Number of compounds shown and counted as selected
+TOP_K = 50
+
+# Directory holding the distances of each file, so only changed files are recomputed on the next run
+DISTANCE_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.distance_cache')
 
 # List of relevant columns to process
 # TODO: Replace hard coded columns
@@ -25,105 +40,285 @@ comparisons = [
     ("Log2 Fold Change: (no2-cla/lps) / (lps)", "P-value: (no2-cla/lps) / (lps)")
 ]
 
-# Process each file
-for file in files:
-    # Load the CSV file into a DataFrame with appropriate encoding
-    df = pd.read_csv(file, encoding='ISO-8859-1')
-    
-    # Process each comparison
-    for log2fc_col, pval_col in comparisons:
-        if log2fc_col in df.columns and pval_col in df.columns:
-            # Calculate -log10(p-value)
-            df['-log10(p-value)'] = -np.log10(df[pval_col])
-            
-            # Filter rows where 'Checked' is True
-            checked_df = df[df['Checked'] == True]
-            
-            # Find leftmost, rightmost, and topmost points
-            leftmost_x = checked_df[log2fc_col].min()
-            rightmost_x = checked_df[log2fc_col].max()
-            topmost_y = checked_df['-log10(p-value)'].max()
-            
-            # Iterate over each checked compound to calculate distances
-            for index, row in checked_df.iterrows():
-                x = row[log2fc_col]
-                y = row['-log10(p-value)']
-                
-                # Calculate the distance
-                if x < 0:
-                    distance = np.sqrt((x - leftmost_x) ** 2 + (y - topmost_y) ** 2)
-                else:
-                    distance = np.sqrt((x - rightmost_x) ** 2 + (y - topmost_y) ** 2)
-                
-                # Add this distance to the list for this compound
-                compound_id = row['Compounds ID']
-                compound_distances[compound_id].append((distance, file))
-
-# Process compound distances, detecting outliers and optionally removing them
-final_distances = {}
-
-for compound_id, distance_file_pairs in compound_distances.items():
-    distances = np.array([pair[0] for pair in distance_file_pairs])
-    files_list = [pair[1] for pair in distance_file_pairs]
-    
-    if len(distances) > 1:
-        # Calculate the median and MAD (Median Absolute Deviation)
-        median = np.median(distances)
-        mad = np.median(np.abs(distances - median))
-        
-        # Avoid division by zero in MAD calculation
-        if mad == 0:
-            mad = np.std(distances)
-        
-        # Calculate modified Z-scores
-        modified_z_scores = 0.6745 * (distances - median) / mad
-        
-        # Identify the most significant outlier
-        max_z_index = np.argmax(np.abs(modified_z_scores))
-        detected_file = files_list[max_z_index]
-        
-        # Track the file where the outlier was detected
-        outlier_detected_files[compound_id].append(detected_file)
-        
-        if REMOVE_OUTLIER:
-            # Remove the most significant outlier
-            filtered_distances = np.delete(distances, max_z_index)
-            files_list = np.delete(files_list, max_z_index).tolist()
-        else:
-            filtered_distances = distances
-    else:
-        filtered_distances = distances
-    
+# Compute the distance of every checked compound to the regions of interest for all comparisons at once
+def compute_distances(df, comparisons):
+    # Keep only the comparisons present in this file
+    present = [(log2fc_col, pval_col) for log2fc_col, pval_col in comparisons
+               if log2fc_col in df.columns and pval_col in df.columns]
+
+    # Filter rows where 'Checked' is True
+    checked_df = df[df['Checked'] == True]
+    compound_ids = checked_df['Compounds ID'].to_numpy()
+
+    # Build the compound x comparison frames of fold changes and -log10(p-value)
+    x = checked_df[[log2fc_col for log2fc_col, _ in present]].astype(float)
+    y = -np.log10(checked_df[[pval_col for _, pval_col in present]].astype(float))
+
+    # Find leftmost, rightmost, and topmost points of each comparison
+    leftmost_x = x.min().to_numpy()
+    rightmost_x = x.max().to_numpy()
+    topmost_y = y.max().to_numpy()
+    x = x.to_numpy()
+    y = y.to_numpy()
+
+    # Downregulated compounds are measured against the leftmost point, all others against the rightmost
+    # (float_power goes through pow() like the scalar arithmetic did, so the distances match bit for bit)
+    anchor_x = np.where(x < 0, leftmost_x, rightmost_x)
+    distances = np.sqrt(np.float_power(x - anchor_x, 2) + np.float_power(y - topmost_y, 2))
+
+    return compound_ids, distances, present
+
+# Path of the stored distances for one file
+def distance_cache_path(file):
+    key = hashlib.sha1(os.path.abspath(file).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(DISTANCE_CACHE_DIR, f"{os.path.basename(file)}-{key}.npz")
+
+# Load the stored distances of a file if neither the file nor the comparisons changed since they were computed
+def load_cached_distances(file, comparisons):
+    try:
+        with np.load(distance_cache_path(file)) as entry:
+            stored_comparisons = entry['comparisons'].tolist()
+            fingerprint = json.loads(str(entry['fingerprint']))
+            compound_ids, distances = entry['compound_ids'], entry['distances']
+    except (OSError, KeyError, ValueError):
+        return None
+
+    if stored_comparisons != [col for pair in comparisons for col in pair]:
+        return None
+    current = check_fingerprint(file, fingerprint)
+    if current is None:
+        return None
+    if current != fingerprint:
+        save_cached_distances(file, comparisons, compound_ids, distances, current)
+    return compound_ids, distances
+
+# Store the distances of a file together with its fingerprint
+def save_cached_distances(file, comparisons, compound_ids, distances, fingerprint):
+    os.makedirs(DISTANCE_CACHE_DIR, exist_ok=True)
+    np.savez(
+        distance_cache_path(file),
+        compound_ids=compound_ids,
+        distances=distances,
+        comparisons=np.array([col for pair in comparisons for col in pair]),
+        fingerprint=np.array(json.dumps(fingerprint))
+    )
+
+# Detect outliers and calculate the final distance for a batch of compounds with the same number of distances
+def summarize_group(distances, remove_outlier=False):
+    if distances.shape[-1] == 1:
+        return distances[..., 0], np.zeros(distances.shape[:-1], dtype=int)
+
+    # Calculate the median and MAD (Median Absolute Deviation)
+    median = np.median(distances, axis=-1, keepdims=True)
+    mad = np.median(np.abs(distances - median), axis=-1, keepdims=True)
+
+    # Avoid division by zero in MAD calculation
+    mad = np.where(mad == 0, np.std(distances, axis=-1, keepdims=True), mad)
+
+    # Calculate modified Z-scores
+    modified_z_scores = 0.6745 * (distances - median) / mad
+
+    # Identify the most significant outlier
+    max_z_index = np.argmax(np.abs(modified_z_scores), axis=-1)
+
+    if remove_outlier:
+        # Remove the most significant outlier
+        kept = np.arange(distances.shape[-1]) != max_z_index[..., None]
+        distances = distances[kept].reshape(distances.shape[:-1] + (distances.shape[-1] - 1,))
+
     # Calculate the weighted average distance (weights are inversely proportional to the variance)
-    if len(filtered_distances) > 1:
-        weights = 1 / np.var(filtered_distances)
-        final_distance = np.average(filtered_distances, weights=np.full_like(filtered_distances, weights))
+    if distances.shape[-1] > 1:
+        weights = np.repeat(1 / np.var(distances, axis=-1, keepdims=True), distances.shape[-1], axis=-1)
+        final_distance = np.multiply(distances, weights).sum(axis=-1) / weights.sum(axis=-1)
+    else:
+        final_distance = distances[..., 0]
+
+    return final_distance, max_z_index
+
+# Move the entries of every compound that are present to the front, keeping their order; a present entry may still be
+# NaN (a checked compound without a fold change or p-value), which makes its total NaN and ranks it last
+def compact_distances(distances, present=None):
+    distances = np.asarray(distances, dtype=float)
+    if present is None:
+        present = np.ones(distances.shape, dtype=bool)
+    order = np.argsort(~present, axis=-1, kind='stable')
+    return np.take_along_axis(distances, order, axis=-1), present.sum(axis=-1), order
+
+# Summarize compacted distances of shape (..., compounds, entries); compounds with the same number of distances are summarized together
+def summarize_compact(compact, counts, remove_outlier=False):
+    final_distances = np.full(compact.shape[:-1], np.nan)
+    max_z_indices = np.full(compact.shape[:-1], -1)
+    # Identical distances (MAD and variance of 0, common among resamples) give NaN or inf by design
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for count in np.unique(counts[counts > 0]):
+            rows = np.flatnonzero(counts == count)
+            final_distances[..., rows], max_z_index = summarize_group(compact[..., rows, :count], remove_outlier)
+            if count > 1:
+                max_z_indices[..., rows] = max_z_index
+    return final_distances, max_z_indices
+
+# Summarize the compound x (file, comparison) distance matrix; present marks the entries of the files a compound is in
+def summarize_distances(distances, present=None, remove_outlier=False):
+    compact, counts, order = compact_distances(distances, present)
+    final_distances, max_z_indices = summarize_compact(compact, counts, remove_outlier)
+
+    # Translate the outlier positions back to columns of the matrix
+    outlier_columns = np.where(max_z_indices >= 0, np.take_along_axis(order, np.maximum(max_z_indices, 0)[:, None], axis=1)[:, 0], -1)
+    return final_distances, outlier_columns
+
+# Rank every compound by total distance (1 = closest), once per resample
+def rank_distances(totals):
+    ranks = np.empty(totals.shape, dtype=np.int32)
+    order = np.argsort(totals, axis=-1)
+    np.put_along_axis(ranks, order, np.arange(1, totals.shape[-1] + 1, dtype=np.int32)[None, :], axis=-1)
+    return ranks
+
+# Run one chunk of resamples; executed in a worker process
+def resample_chunk(distances, present, mode, n_resamples, seed, remove_outlier):
+    rng = np.random.default_rng(seed)
+    compact, counts, order = compact_distances(distances, present)
+    observed_totals, _ = summarize_compact(compact, counts, remove_outlier)
+    observed_rows = [np.flatnonzero(present[:, j]) for j in range(distances.shape[1])]
+
+    # Keep every batch of resampled matrices at a few million values
+    batch_size = max(1, 4_000_000 // max(distances.size, 1))
+    ranks = []
+    for start in range(0, n_resamples, batch_size):
+        size = min(batch_size, n_resamples - start)
+
+        if mode == 'bootstrap':
+            # Draw each compound's distances with replacement from its own observed distances
+            draws = (rng.random((size,) + compact.shape) * counts[:, None]).astype(np.intp)
+            resampled = np.take_along_axis(np.broadcast_to(compact, (size,) + compact.shape), draws, axis=-1)
+            totals, _ = summarize_compact(resampled, counts, remove_outlier)
+            ranks.append(rank_distances(totals))
+        else:
+            # Shuffle which compound each distance belongs to within every (file, comparison) column
+            permuted = np.broadcast_to(distances, (size,) + distances.shape).copy()
+            for j, rows in enumerate(observed_rows):
+                shuffled = np.argsort(rng.random((size, len(rows))), axis=-1)
+                permuted[:, rows, j] = distances[rows[shuffled], j]
+            null_totals, _ = summarize_compact(np.take_along_axis(permuted, np.broadcast_to(order, permuted.shape), axis=-1), counts, remove_outlier)
+
+            # Rank the observed totals against the compounds assembled by chance
+            null_totals = np.sort(null_totals, axis=-1)
+            ranks.append(np.stack([np.searchsorted(null, observed_totals) + 1 for null in null_totals]).astype(np.int32))
+
+    return np.concatenate(ranks)
+
+# Select the k rows with the smallest values in sorted order without sorting everything
+def select_top_k(result, column, k):
+    values = result[column].to_numpy()
+    if k < len(values):
+        candidates = np.argpartition(np.where(np.isnan(values), np.inf, values), k)[:k]
     else:
-        final_distance = filtered_distances[0]
-    
-    final_distances[compound_id] = final_distance
+        candidates = np.arange(len(values))
+    # Ties keep their original order
+    top = candidates[np.lexsort((candidates, values[candidates]))]
+    return result.iloc[top]
+
+# Resample the distances in parallel and report rank confidence intervals and selection frequencies
+def resample_ranking(distances, present, mode='bootstrap', n_resamples=N_RESAMPLES, top_k=TOP_K, remove_outlier=False, seed=None, max_workers=None):
+    if mode not in ('bootstrap', 'permutation'):
+        raise ValueError(f"Unknown resampling mode: {mode}")
+
+    # Split the resamples into independent, reproducibly seeded chunks
+    max_workers = max_workers or os.cpu_count() or 1
+    n_chunks = min(n_resamples, max_workers * 4)
+    chunk_sizes = [len(chunk) for chunk in np.array_split(np.arange(n_resamples), n_chunks)]
+    seeds = np.random.SeedSequence(seed).spawn(n_chunks)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        chunks = executor.map(resample_chunk, repeat(distances), repeat(present), repeat(mode), chunk_sizes, seeds, repeat(remove_outlier))
+        ranks = np.concatenate(list(chunks))
 
-# Convert the distances dictionary to a DataFrame
-compound_distance_df = pd.DataFrame.from_dict(final_distances, orient='index', columns=['Total Distance'])
+    rank_low, rank_high = np.percentile(ranks, [2.5, 97.5], axis=0)
+    return pd.DataFrame({
+        'Rank CI Low': rank_low,
+        'Rank CI High': rank_high,
+        'Selection Frequency': (ranks <= top_k).mean(axis=0)
+    })
+
+def main():
+    # Reuse the distances of every file that has not changed since the last run
+    cached_blocks = {file: load_cached_distances(file, comparisons) for file in files}
+    changed_files = [file for file in files if cached_blocks[file] is None]
+
+    # Load only the columns used here from all changed files at once
+    columns = ['Compounds ID', 'Checked', 'Name', 'Calc. MW'] + [col for pair in comparisons for col in pair]
+    dtypes = {'Compounds ID': 'int64', 'Checked': bool, 'Name': object, 'Calc. MW': float}
+    dtypes.update({col: float for pair in comparisons for col in pair})
+    if changed_files:
+        print(f"Computing distances for: {', '.join(changed_files)}")
+        exports = load_exports(changed_files, columns=columns, dtype=dtypes)
+
+    # Process each changed file
+    for file in changed_files:
+        df = export_rows(exports, file)
+
+        compound_ids, distances, present = compute_distances(df, comparisons)
+        cached_blocks[file] = (compound_ids, distances)
+        save_cached_distances(file, comparisons, compound_ids, distances, file_fingerprint(file))
+    file_blocks = [cached_blocks[file] for file in files]
+
+    # Build the dense compound x (file, comparison) matrix, keeping compounds in order of first appearance
+    all_compound_ids = pd.unique(np.concatenate([compound_ids for compound_ids, _ in file_blocks]))
+    distance_matrix = np.hstack([
+        pd.DataFrame(distances, index=compound_ids).reindex(all_compound_ids).to_numpy()
+        for compound_ids, distances in file_blocks
+    ])
+    column_files = [file for file, (_, distances) in zip(files, file_blocks) for _ in range(distances.shape[1])]
+
+    # A compound has entries only for the files it is checked in; NaN distances within those files still count
+    present_matrix = np.hstack([
+        np.repeat(np.isin(all_compound_ids, compound_ids)[:, None], distances.shape[1], axis=1)
+        for compound_ids, distances in file_blocks
+    ])
+
+    # Process compound distances, detecting outliers and optionally removing them
+    final_distances, outlier_columns = summarize_distances(distance_matrix, present_matrix, REMOVE_OUTLIER)
+
+    # Track the file where the outlier was detected
+    outlier_detected_files = defaultdict(list)
+    for compound_id, column in zip(all_compound_ids, outlier_columns):
+        if column >= 0:
+            outlier_detected_files[compound_id].append(column_files[column])
+
+    # Convert the distances to a DataFrame
+    compound_distance_df = pd.DataFrame({'Total Distance': final_distances}, index=all_compound_ids)
+    result_columns = ['Name', 'Total Distance', 'Outlier Detected In']
+
+    # Optionally, estimate how stable the ranking is
+    if RESAMPLE_MODE is not None:
+        confidence = resample_ranking(distance_matrix, present_matrix, RESAMPLE_MODE, N_RESAMPLES, TOP_K, REMOVE_OUTLIER, RESAMPLE_SEED, RESAMPLE_WORKERS)
+        confidence.index = all_compound_ids
+        compound_distance_df = compound_distance_df.join(confidence)
+        result_columns += confidence.columns.tolist()
+
+    # Take the mapping for compound IDs to Names and Calc. MW from one of the files
+    if files[0] in changed_files:
+        mapping_df = export_rows(exports, files[0])
+    else:
+        mapping_df = read_export(files[0], columns=['Compounds ID', 'Name', 'Calc. MW'], dtype=dtypes)
 
-# Load the mapping for compound IDs to Names and Calc. MW from one of the files
-mapping_df = pd.read_csv(files[0], encoding='ISO-8859-1')
+    # Map Compound IDs to Names and Calc. MW, and handle NaN in Names
+    mapping = mapping_df[['Compounds ID', 'Name', 'Calc. MW']].drop_duplicates()
+    mapping['Name'] = mapping['Name'].fillna(mapping['Calc. MW'])
 
-# Map Compound IDs to Names and Calc. MW, and handle NaN in Names
-mapping = mapping_df[['Compounds ID', 'Name', 'Calc. MW']].drop_duplicates()
-mapping['Name'] = mapping['Name'].fillna(mapping['Calc. MW'])
+    # Merge the distances with the mapping
+    compound_distance_named_df = compound_distance_df.merge(mapping, left_index=True, right_on='Compounds ID')
 
-# Merge the distances with the mapping
-compound_distance_named_df = compound_distance_df.merge(mapping, left_index=True, right_on='Compounds ID')
+    # Add information about where outliers were detected, if applicable
+    compound_distance_named_df['Outlier Detected In'] = compound_distance_named_df['Compounds ID'].map(outlier_detected_files)
 
-# Add information about where outliers were detected, if applicable
-compound_distance_named_df['Outlier Detected In'] = compound_distance_named_df['Compounds ID'].map(outlier_detected_files)
+    # Select only relevant columns: Name, Total Distance, Outlier Detected In and the resampling results
+    final_result = compound_distance_named_df[result_columns]
 
-# Select only relevant columns: Name, Total Distance, and Outlier Detected In
-final_result = compound_distance_named_df[['Name', 'Total Distance', 'Outlier Detected In']].sort_values(by='Total Distance')
+    # Display the top compounds by total distance with names
+    print(select_top_k(final_result, 'Total Distance', TOP_K))
 
-# Display the top 50 compounds by total distance with names
-print(final_result.head(50))
+    # Optionally, save the final result, ranked by total distance, to a CSV file
+    final_result.sort_values(by='Total Distance').to_csv('significant_compounds_by_distance_named_v5.csv', index=False)
 
-# Optionally, save the final result to a CSV file
-final_result.to_csv('significant_compounds_by_distance_named_v5.csv', index=False)
+if __name__ == '__main__':
+    main()
@@ -1,55 +1,307 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
 import numpy as np
-import plotly.figure_factory as ff
+import plotly.graph_objects as go
 import plotly.io as pio
-import chardet
-import matplotlib.colors as mcolors
-import matplotlib.cm as cm
+import matplotlib
+from scipy import sparse, special
+from scipy.sparse.csgraph import connected_components, reverse_cuthill_mckee
 
-# Function to detect file encoding
-def detect_encoding(file_path):
-    with open(file_path, 'rb') as file:
-        result = chardet.detect(file.read(100000))  #Bytes for detection
-        return result['encoding']
+from exports import read_export
 
 # Function to calculate luminance of a color (0 = dark, 1 = light)
 def calculate_luminance(rgb):
     r, g, b = rgb
     return 0.299 * r + 0.587 * g + 0.114 * b
 
-# Function to get RGB from colorscale
-def get_rgb_from_colorscale(value, vmin, vmax, colorscale='RdBu'):
-    norm_value = (value - vmin) / (vmax - vmin)  # Normalize value between 0 and 1
-    cmap = cm.get_cmap(colorscale)
-    rgba = cmap(norm_value)
-    rgb = mcolors.to_rgb(rgba)
-    return rgb
-
-# Function to determine text color based on background color luminance
-def get_text_color_by_luminance(value, vmin, vmax, threshold=0.5):
-    if np.isnan(value):
-        return "black"
-    rgb = get_rgb_from_colorscale(value, vmin, vmax)
-    luminance = calculate_luminance(rgb)
-    return "white" if luminance < threshold else "black"
+# Function to get RGB from colorscale for a whole array of values (RGB is the last axis)
+def get_rgb_from_colorscale(values, vmin, vmax, colorscale='RdBu'):
+    norm_values = (values - vmin) / (vmax - vmin)  # Normalize values between 0 and 1
+    cmap = matplotlib.colormaps[colorscale]
+    return cmap(norm_values)[..., :3]
+
+# Function to determine text colors based on background color luminance for a whole array of values
+def get_text_color_by_luminance(values, vmin, vmax, threshold=0.5, colorscale='RdBu'):
+    rgb = get_rgb_from_colorscale(values, vmin, vmax, colorscale)
+    luminance = calculate_luminance(np.moveaxis(rgb, -1, 0))
+    colors = np.where(luminance < threshold, "white", "black")
+    return np.where(np.isnan(values), "black", colors)
+
+# Function to compute one block of Pearson correlations from column-centered values (NaN replaced by 0) and the observation mask
+def pearson_block(block, values, mask):
+    x, m = values[:, block], mask[:, block]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Sample counts and sums over the rows where both columns are present
+        n_obs = m.T @ mask
+        sum_x = x.T @ mask
+        sum_y = m.T @ values
+        sum_xx = (x * x).T @ mask
+        sum_yy = m.T @ (values * values)
+        sum_xy = x.T @ values
+
+        cov = sum_xy - sum_x * sum_y / n_obs
+        var_x = sum_xx - sum_x * sum_x / n_obs
+        var_y = sum_yy - sum_y * sum_y / n_obs
+        corr = cov / np.sqrt(var_x * var_y)
+    return np.clip(corr, -1, 1), n_obs
+
+# Function to accumulate the Kendall concordance sums over the pairs (i, j > i) for one chunk of rows i
+def kendall_chunk(rows, values, mask):
+    # Signs of all pairwise differences; pairs with a missing value get sign 0 and are not valid
+    signs = np.sign(values[rows, None, :] - values[None, :, :])
+    later = np.arange(len(values))[None, :] > rows[:, None]
+    valid = (mask[rows, None, :] & mask[None, :, :]) & later[..., None]
+    signs = np.where(valid, signs, 0).reshape(-1, values.shape[1])
+    valid = valid.reshape(-1, values.shape[1])
+
+    untied = np.abs(signs)
+    return signs.T @ signs, untied.T @ valid, valid.T.astype(float) @ valid
+
+# Function to compute a correlation matrix (Pearson, Spearman or Kendall) in column blocks across a thread pool
+def compute_correlation(data, method='pearson', pairwise=False, block_size=256, n_threads=None, dtype=np.float64):
+    if method not in ('pearson', 'spearman', 'kendall'):
+        raise ValueError(f"Unknown correlation method: {method}")
+
+    values = data.to_numpy(dtype=np.float64)
+    if not pairwise:
+        # Only use the rows without missing values
+        values = values[~np.isnan(values).any(axis=1)]
+    # Like DataFrame.corr, infinite values (e.g. ratios against a zero area) are left out pairwise
+    values = np.where(np.isfinite(values), values, np.nan)
+    if method == 'spearman':
+        # Rank every column once; Spearman is then Pearson on the ranks
+        values = pd.DataFrame(values).rank().to_numpy()
+
+    mask = ~np.isnan(values)
+    n_threads = n_threads or os.cpu_count() or 1
+    n_columns = values.shape[1]
+
+    if method == 'kendall':
+        # Keep every chunk of pair signs at a few million values
+        chunk_size = max(1, 2_000_000 // max(len(values) * n_columns, 1))
+        chunks = [np.arange(start, min(start + chunk_size, len(values))) for start in range(0, len(values), chunk_size)]
+        concordance = np.zeros((n_columns, n_columns))
+        untied = np.zeros((n_columns, n_columns))
+        n_pairs = np.zeros((n_columns, n_columns))
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            for chunk_concordance, chunk_untied, chunk_pairs in executor.map(lambda rows: kendall_chunk(rows, values, mask), chunks):
+                concordance += chunk_concordance
+                untied += chunk_untied
+                n_pairs += chunk_pairs
+
+        # Tau-b: ties in either column are excluded from that column's normalization
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corr = concordance / np.sqrt(untied * untied.T)
+        n_obs = mask.T.astype(float) @ mask
+        corr[n_pairs == 0] = np.nan
+    else:
+        # Center every column so the sums stay small, then work in the requested precision
+        with np.errstate(invalid='ignore'):
+            centered = np.where(mask, values - np.nanmean(values, axis=0) if len(values) else values, 0).astype(dtype)
+        mask_values = mask.astype(dtype)
+
+        blocks = [np.arange(start, min(start + block_size, n_columns)) for start in range(0, n_columns, block_size)]
+        corr = np.empty((n_columns, n_columns))
+        n_obs = np.empty((n_columns, n_columns))
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            for block, (block_corr, block_n_obs) in zip(blocks, executor.map(lambda block: pearson_block(block, centered, mask_values), blocks)):
+                corr[block] = block_corr
+                n_obs[block] = block_n_obs
+
+    np.fill_diagonal(corr, np.where(np.diag(n_obs) > 1, 1.0, np.nan))
+    corr = pd.DataFrame(corr, index=data.columns, columns=data.columns)
+    return corr, pd.DataFrame(n_obs.astype(int), index=data.columns, columns=data.columns)
+
+# Function to adjust p-values with the Benjamini-Hochberg procedure (NaN p-values are left out)
+def benjamini_hochberg(p_values):
+    adjusted = np.full(p_values.shape, np.nan)
+    valid = np.flatnonzero(~np.isnan(p_values))
+    order = valid[np.argsort(p_values[valid])]
+    ranked = p_values[order] * len(order) / np.arange(1, len(order) + 1)
+    adjusted[order] = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1)
+    return adjusted
+
+# Function to compute the two-sided p-values of correlations r over n observations, I_(1-r^2)((n - 2)/2, 1/2) of the t-distribution
+def t_test_p_values(r, n):
+    r = np.asarray(r, dtype=np.float64)
+    n = np.asarray(n, dtype=np.float64)
+    return special.betainc((n - 2) / 2, 0.5, np.clip((1 - r) * (1 + r), 0, 1))
+
+# Function to compute the t-statistic, p-value and adjusted p-value of every pair of columns from the correlation matrix
+def correlation_significance(corr, n_obs, method='pearson'):
+    # Every pair is tested once (lower triangle) and mirrored
+    rows, cols = np.tril_indices(len(corr), k=-1)
+    r = corr.to_numpy()[rows, cols]
+    n = n_obs.to_numpy()[rows, cols].astype(float)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if method == 'kendall':
+            # Normal approximation of tau under independence (without tie correction)
+            statistic = 3 * r * np.sqrt(n * (n - 1)) / np.sqrt(2 * (2 * n + 5))
+            p_values = special.erfc(np.abs(statistic) / np.sqrt(2))
+        else:
+            # t-distribution with n - 2 degrees of freedom (also used for Spearman)
+            dof = n - 2
+            statistic = r * np.sqrt(dof / ((1 - r) * (1 + r)))
+            p_values = t_test_p_values(r, n)
+    p_values = np.where(np.isnan(r) | (n < 3), np.nan, p_values)
+
+    # Adjust for the number of pairs tested
+    adjusted = benjamini_hochberg(p_values)
+
+    results = []
+    for pair_values in (statistic, p_values, adjusted):
+        matrix = np.full(corr.shape, np.nan)
+        matrix[rows, cols] = matrix[cols, rows] = pair_values
+        results.append(pd.DataFrame(matrix, index=corr.index, columns=corr.columns))
+    return tuple(results)
+
+# Function to write the significance of every pair of columns as CSV (or Parquet for a .parquet path)
+def write_significance(corr, n_obs, statistic, p_values, adjusted, output_path):
+    rows, cols = np.tril_indices(len(corr), k=-1)
+    pairs = pd.DataFrame({
+        'Column 1': corr.index.to_numpy()[rows],
+        'Column 2': corr.columns.to_numpy()[cols],
+        'r': corr.to_numpy()[rows, cols],
+        'n': n_obs.to_numpy()[rows, cols],
+        'Statistic': statistic.to_numpy()[rows, cols],
+        'P-value': p_values.to_numpy()[rows, cols],
+        'Adj. P-value': adjusted.to_numpy()[rows, cols]
+    })
+    if output_path.endswith('.parquet'):
+        pairs.to_parquet(output_path, index=False)
+    else:
+        pairs.to_csv(output_path, index=False)
+
+# Function to find the edges above the threshold between one block of compounds and every later compound
+def compound_edges_block(start, stop, values, mask, threshold, min_samples, max_p_value):
+    # Only compare against compounds from the start of the block on (the upper triangle)
+    block_corr, n_obs = pearson_block(np.arange(stop - start), values[:, start:], mask[:, start:])
+
+    # A pair needs min_samples shared samples; two shared samples always give r = +-1
+    edges = (np.abs(block_corr) >= threshold) & (n_obs >= min_samples)
+    local_rows, local_cols = np.nonzero(edges & np.triu(np.ones(block_corr.shape, dtype=bool), k=1))
+    corr = block_corr[local_rows, local_cols]
+    if max_p_value is not None:
+        significant = t_test_p_values(corr, n_obs[local_rows, local_cols]) <= max_p_value
+        local_rows, local_cols, corr = local_rows[significant], local_cols[significant], corr[significant]
+    return local_rows + start, local_cols + start, corr
+
+# Function to correlate compounds across samples blockwise, keeping only edges with |r| >= threshold (and p <= max_p_value) in a sparse matrix;
+# with only a handful of samples a high |r| is easily reached by chance, hence the sample minimum and the p-value cutoff
+def compute_compound_network(sample_data, threshold=0.8, method='pearson', min_samples=5, max_p_value=0.05, block_size=256, n_threads=None, dtype=np.float32):
+    if method not in ('pearson', 'spearman'):
+        raise ValueError(f"Unsupported method for the compound network: {method}")
+
+    # Samples are the observations and compounds the variables
+    values = sample_data.to_numpy(dtype=np.float64).T
+    values = np.where(np.isfinite(values), values, np.nan)
+    if method == 'spearman':
+        # Rank every compound across the samples once
+        values = pd.DataFrame(values).rank().to_numpy()
+    mask = ~np.isnan(values)
+
+    # Compounds seen in too few samples cannot give a meaningful correlation
+    kept = np.flatnonzero(mask.sum(axis=0) >= min_samples)
+    values, mask = values[:, kept], mask[:, kept]
+    with np.errstate(invalid='ignore'):
+        centered = np.where(mask, values - np.nanmean(values, axis=0) if len(values) else values, 0).astype(dtype)
+    mask_values = mask.astype(dtype)
+
+    # The dense matrix is never built: every block only hands back its edges
+    n_compounds = len(kept)
+    blocks = [(start, min(start + block_size, n_compounds)) for start in range(0, n_compounds, block_size)]
+    with ThreadPoolExecutor(max_workers=n_threads or os.cpu_count() or 1) as executor:
+        edges = list(executor.map(lambda block: compound_edges_block(*block, centered, mask_values, threshold, min_samples, max_p_value), blocks))
+
+    rows = np.concatenate([block_rows for block_rows, _, _ in edges] + [np.empty(0, dtype=int)])
+    cols = np.concatenate([block_cols for _, block_cols, _ in edges] + [np.empty(0, dtype=int)])
+    corr = np.concatenate([block_corr for _, _, block_corr in edges] + [np.empty(0)]).astype(np.float64)
+
+    # Store the edges as a symmetric CSR matrix over all compounds of the input
+    n_total = sample_data.shape[0]
+    upper = sparse.coo_matrix((corr, (kept[rows], kept[cols])), shape=(n_total, n_total))
+    return (upper + upper.T).tocsr()
+
+# Function to order the compounds of a network so that co-regulated modules sit together
+def cluster_network(network):
+    n_modules, modules = connected_components(network, directed=False)
+    order = reverse_cuthill_mckee(network, symmetric_mode=True)
+
+    # Keep every module contiguous, largest first, in bandwidth-reducing order within the module
+    module_sizes = np.bincount(modules, minlength=n_modules)
+    position = np.empty(len(order), dtype=int)
+    position[order] = np.arange(len(order))
+    order = np.lexsort((position, modules, -module_sizes[modules]))
+    return modules, order
+
+# Function to write the compound correlation network of an export as an edge list and a clustered node list.
+# The samples should be independent measurements of every compound, e.g. per-sample areas or 'Group Area:' columns;
+# 'Ratio:' columns are derived from shared denominators and correlate through them, so they make poor samples
+def generate_compound_network_csv(file_path, output_csv, sample_prefix='Group Area:', threshold=0.8, method='pearson', min_samples=5, max_p_value=0.05):
+    data = read_export(file_path, encoding=None)
+
+    # Select the sample columns and label every compound
+    sample_columns = [col for col in data.columns if col.startswith(sample_prefix)]
+    sample_data = data[sample_columns].apply(pd.to_numeric, errors='coerce')
+    labels = data['Name'].fillna(data['Formula']).fillna(data['Calc. MW'].astype(str))
+
+    network = compute_compound_network(sample_data, threshold=threshold, method=method, min_samples=min_samples, max_p_value=max_p_value)
+    modules, order = cluster_network(network)
+
+    # Write every edge once, in clustered order, with the samples it rests on and its p-value
+    upper = sparse.triu(network, k=1).tocoo()
+    observed = np.isfinite(sample_data.to_numpy(dtype=np.float64))
+    n_obs = (observed[upper.row] & observed[upper.col]).sum(axis=1)
+    edges = pd.DataFrame({
+        'Source ID': data['Compounds ID'].to_numpy()[upper.row],
+        'Source': labels.to_numpy()[upper.row],
+        'Target ID': data['Compounds ID'].to_numpy()[upper.col],
+        'Target': labels.to_numpy()[upper.col],
+        'r': upper.data,
+        'Samples': n_obs,
+        'P-value': t_test_p_values(upper.data, n_obs),
+        'Module': modules[upper.row]
+    })
+    rank = np.empty(len(order), dtype=int)
+    rank[order] = np.arange(len(order))
+    edges = edges.iloc[np.lexsort((rank[upper.col], rank[upper.row]))]
+    edges.to_csv(output_csv, index=False)
+
+    # Write the compounds in clustered order, with their module and number of edges
+    nodes = pd.DataFrame({
+        'Compounds ID': data['Compounds ID'].to_numpy()[order],
+        'Name': labels.to_numpy()[order],
+        'Module': modules[order],
+        'Degree': np.diff(network.indptr)[order]
+    })
+    nodes_csv = f"{os.path.splitext(output_csv)[0]}_nodes.csv"
+    nodes.to_csv(nodes_csv, index=False)
+
+    print(f"Compound network with {len(edges)} edges (|r| >= {threshold}, p <= {max_p_value}) over {len(sample_columns)} '{sample_prefix}' columns written to '{output_csv}' and '{nodes_csv}'.")
+    return network
 
 # Function to generate the correlation heatmap and save as HTML
-def generate_correlation_heatmap_html(file_path, output_html, threshold=0.5):
-    # Detect the encoding of the CSV file
-    encoding = detect_encoding(file_path)
-    
-    # Load the CSV file using the detected encoding
-    data = pd.read_csv(file_path, encoding=encoding)
+def generate_correlation_heatmap_html(file_path, output_html, threshold=0.5, method='pearson', pairwise=False, significance_output=None):
+    # Load the CSV file using the detected encoding (both are cached between runs)
+    data = read_export(file_path, encoding=None)
 
     # Select the 'Ratio' columns
     ratio_columns = [col for col in data.columns if col.startswith('Ratio:')]
 
-    # Ensure these columns are numeric and drop rows with NaN values
+    # Ensure these columns are numeric
     ratio_data = data[ratio_columns].apply(pd.to_numeric, errors='coerce')
-    cleaned_ratio_data = ratio_data.dropna()
 
-    # Compute the correlation matrix
-    corr_matrix = cleaned_ratio_data.corr()
+    # Compute the correlation matrix, either on the rows without NaN values or on every pair's complete rows
+    corr_matrix, n_obs = compute_correlation(ratio_data, method=method, pairwise=pairwise)
+
+    # Test every pair at once and adjust for the number of pairs
+    statistic, p_values, adjusted_p_values = correlation_significance(corr_matrix, n_obs, method)
+    if significance_output is not None:
+        write_significance(corr_matrix, n_obs, statistic, p_values, adjusted_p_values, significance_output)
 
     # Remove diagonal (self-correlations) by setting them to NaN
     corr_matrix_no_diag = corr_matrix.copy()
@@ -72,45 +324,26 @@ def generate_correlation_heatmap_html(file_path, output_html, threshold=0.5):
     # Use the full gradient from blue to red
     colorscale = 'RdBu'  # Continuous gradient from blue to red
 
-    # Create the heatmap figure using Plotly
-    fig = ff.create_annotated_heatmap(
+    # Color every label according to the luminance of its cell, all at once
+    text_colors = get_text_color_by_luminance(z_values, vmin, vmax, threshold, colorscale)
+    styled_text = np.char.add(np.char.add(np.char.add('<span style="color:', text_colors), '">'), annotation_text)
+    styled_text = np.where(annotation_text == "", "", np.char.add(styled_text, '</span>'))
+
+    # Create the heatmap figure using Plotly, with the labels drawn by the heatmap trace itself
+    fig = go.Figure(go.Heatmap(
         z=z_values,
         x=corr_matrix.columns.tolist(),
         y=corr_matrix.index.tolist(),
-        annotation_text=annotation_text,
+        text=styled_text,
+        texttemplate="%{text}",
+        textfont=dict(size=12),  # The color markup would otherwise shrink the automatic label size
         colorscale=colorscale,
         showscale=True,
         zmin=vmin,
         zmax=vmax,
-        hoverinfo="z"
-    )
-
-    # Apply the text color to each annotation based on their x and y positions
-    for annotation in fig.layout.annotations:
-        # Get the x (column) and y (row) labels
-        x_label = annotation.x
-        y_label = annotation.y
-
-        # Find the corresponding row and column indices
-        try:
-            row = corr_matrix.index.tolist().index(y_label)
-            col = corr_matrix.columns.tolist().index(x_label)
-        except ValueError:
-            # If label not found, default to black
-            annotation.font.color = "black"
-            print(f"Label not found for X: {x_label}, Y: {y_label}. Setting Text Color: black")
-            continue
-
-        # Get the corresponding z_value
-        if row < z_values.shape[0] and col < z_values.shape[1]:
-            value = z_values[row][col]
-            color = get_text_color_by_luminance(value, vmin, vmax, threshold)
-            annotation.font.color = color
-            # Debugging: Print the mapping and color decision
-            print(f"Row: {row}, Column: {col}, Value: {value}, Text Color: {color}")
-        else:
-            annotation.font.color = "black"
-            print(f"Row: {row}, Column: {col}, Out of bounds. Setting Text Color: black")
+        customdata=np.dstack([p_values.to_numpy(), adjusted_p_values.to_numpy(), n_obs.to_numpy()]),
+        hovertemplate="%{y} vs %{x}<br>r: %{z:.2f}<br>P-value: %{customdata[0]:.1e}<br>Adj. P-value: %{customdata[1]:.1e}<br>n: %{customdata[2]}<extra></extra>"
+    ))
 
     # Update layout to make it visually appealing and remove grid lines
     fig.update_layout(
@@ -137,5 +370,26 @@ output_html = 'correlation.html'
 # Optional: Define a threshold for luminance-based text color
 threshold = 0.5
 
+# Correlation method ('pearson', 'spearman' or 'kendall') and whether to use pairwise-complete rows instead of dropping every row with a NaN
+method = 'pearson'
+pairwise = False
+
+# Output file for the r, p-value and adjusted p-value of every pair (CSV, or Parquet for a .parquet path)
+significance_output = 'correlation_significance.csv'
+
+# Optional: correlate compounds across the sample columns and keep the edges with |r| above this value (None to skip)
+network_threshold = None
+network_method = 'pearson'  # 'pearson' or 'spearman'
+network_output_csv = 'compound_network.csv'
+# Sample columns: independent measurements such as per-sample or group areas, not the derived 'Ratio:' columns
+network_sample_prefix = 'Group Area:'
+# An edge needs this many shared samples and a p-value at most this (None to keep every edge above the threshold)
+network_min_samples = 5
+network_max_p_value = 0.05
+
 # Run the function to generate the heatmap
-generate_correlation_heatmap_html(file_path, output_html, threshold)
\ No newline at end of file
+generate_correlation_heatmap_html(file_path, output_html, threshold, method, pairwise, significance_output)
+
+if network_threshold is not None:
+    generate_compound_network_csv(file_path, network_output_csv, network_sample_prefix, network_threshold, network_method,
+                                  network_min_samples, network_max_p_value)
\ No newline at end of file
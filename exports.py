@@ -0,0 +1,212 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+# Parquet support is optional; without it every export is parsed from the CSV
+try:
+    import pyarrow  # noqa: F401
+    PARQUET_AVAILABLE = True
+except ImportError:
+    PARQUET_AVAILABLE = False
+
+# Encoding used by the Compound Discoverer exports
+DEFAULT_ENCODING = 'ISO-8859-1'
+
+# Column holding the export each row was read from in a merged frame
+SOURCE_COLUMN = 'Source File'
+
+# Directory holding the parsed exports (set LABTOOLS_CACHE_DIR to move it, or to an empty string to disable it)
+CACHE_DIR = os.environ.get('LABTOOLS_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.export_cache'))
+
+# Function to hash the content of a file
+def content_hash(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Function to fingerprint a file by size, modification time and content
+def file_fingerprint(file_path):
+    stat = os.stat(file_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': content_hash(file_path)}
+
+# Check a stored fingerprint against a file; returns the up-to-date fingerprint if the content is unchanged, else None
+def check_fingerprint(file_path, fingerprint):
+    stat = os.stat(file_path)
+    if fingerprint is None or fingerprint['size'] != stat.st_size:
+        return None
+    if fingerprint['mtime_ns'] == stat.st_mtime_ns:
+        return fingerprint
+    # Touched or copied but not modified: only the mtime needs updating
+    if fingerprint['sha256'] == content_hash(file_path):
+        return dict(fingerprint, mtime_ns=stat.st_mtime_ns)
+    return None
+
+# Base path of the cache entries for one export, keyed by its absolute path
+def _cache_base(file_path):
+    key = hashlib.sha1(os.path.abspath(file_path).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, f"{os.path.splitext(os.path.basename(file_path))[0]}-{key}")
+
+# Write a file atomically so concurrent readers never see a partial entry
+def _write_atomic(path, write):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+def _save_index(file_path, index):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    def write(tmp_path):
+        with open(tmp_path, 'w') as file:
+            json.dump(index, file)
+    _write_atomic(_cache_base(file_path) + '.json', write)
+
+# Load the cache index of an export, or start a new one if the export changed
+def _load_index(file_path):
+    try:
+        with open(_cache_base(file_path) + '.json') as file:
+            index = json.load(file)
+    except (OSError, ValueError):
+        index = None
+
+    fingerprint = check_fingerprint(file_path, index)
+    if fingerprint is not None:
+        # Keep the entries of a touched but unchanged file and remember the new mtime
+        if fingerprint['mtime_ns'] != index['mtime_ns']:
+            index.update(fingerprint)
+            _save_index(file_path, index)
+        return index
+
+    index = file_fingerprint(file_path)
+    index.update({'encoding': None, 'frames': {}})
+    return index
+
+# Function to detect file encoding, reusing the cached result when the file has not changed
+def detect_encoding(file_path):
+    index = _load_index(file_path) if CACHE_DIR else None
+    if index is not None and index['encoding']:
+        return index['encoding']
+
+    import chardet
+    with open(file_path, 'rb') as file:
+        encoding = chardet.detect(file.read(100000))['encoding']  # Bytes for detection
+
+    # Only the start is sampled, so plain ASCII there says nothing about the rest; ISO-8859-1 decodes any byte
+    if encoding is None or encoding == 'ascii':
+        encoding = DEFAULT_ENCODING
+    return encoding
+
+# Remember a detected encoding once it has decoded the whole export, so later reads skip the detection
+def _remember_encoding(file_path, encoding, index=None):
+    if not CACHE_DIR:
+        return
+    if index is None:
+        index = _load_index(file_path)
+    if index['encoding'] != encoding:
+        index['encoding'] = encoding
+        _save_index(file_path, index)
+
+# Parse an export; a detected encoding that turns out wrong (e.g. a stale cached one) falls back to ISO-8859-1
+def _read_csv(file_path, encoding, detected, **read_options):
+    try:
+        return pd.read_csv(file_path, encoding=encoding, **read_options), encoding
+    except UnicodeDecodeError:
+        if not detected or encoding == DEFAULT_ENCODING:
+            raise
+    return pd.read_csv(file_path, encoding=DEFAULT_ENCODING, **read_options), DEFAULT_ENCODING
+
+# Parsed frames are stored per set of read options, since those change the parse
+def _options_key(encoding, read_options):
+    return json.dumps({'encoding': encoding, **read_options}, sort_keys=True, default=str)
+
+# Parse a whole export, storing it in the cache when possible; returns the data and the encoding that decoded it
+def _parse_and_cache(file_path, index, encoding, detected, read_options):
+    data, encoding = _read_csv(file_path, encoding, detected, **read_options)
+    if not (CACHE_DIR and PARQUET_AVAILABLE):
+        return data, encoding
+
+    options_key = _options_key(encoding, read_options)
+    frame_path = f"{_cache_base(file_path)}-{hashlib.sha1(options_key.encode('utf-8')).hexdigest()[:8]}.parquet"
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        _write_atomic(frame_path, lambda tmp_path: data.to_parquet(tmp_path, index=False))
+    except (OSError, ValueError, TypeError, pyarrow.ArrowException):
+        # Columns with mixed types cannot be stored; this export is simply parsed every time
+        return data, encoding
+
+    index['frames'][options_key] = {'path': os.path.basename(frame_path), 'columns': data.columns.tolist()}
+    _save_index(file_path, index)
+    return data, encoding
+
+# Read a single export, parsing only the requested columns
+def read_export(file_path, columns=None, dtype=None, encoding=DEFAULT_ENCODING, use_cache=True, **read_options):
+    detected = encoding is None
+    if not (use_cache and CACHE_DIR and PARQUET_AVAILABLE):
+        if detected:
+            encoding = detect_encoding(file_path)
+        # Columns missing from this export are skipped instead of raising
+        usecols = None
+        if columns is not None:
+            wanted = set(columns)
+            usecols = lambda col: col in wanted
+        data, encoding = _read_csv(file_path, encoding, detected, usecols=usecols, dtype=dtype, **read_options)
+        if detected:
+            _remember_encoding(file_path, encoding)
+        return data
+
+    index = _load_index(file_path)
+    if detected:
+        encoding = index['encoding'] or detect_encoding(file_path)
+
+    # Warm start: read only the requested columns of the stored frame
+    wanted = None if columns is None else set(columns)
+    entry = index['frames'].get(_options_key(encoding, read_options))
+    data = None
+    if entry is not None:
+        selected = None if wanted is None else [col for col in entry['columns'] if col in wanted]
+        try:
+            data = pd.read_parquet(os.path.join(CACHE_DIR, entry['path']), columns=selected)
+        except (OSError, ValueError, pyarrow.ArrowException):
+            data = None
+        else:
+            # Missing text comes back as None; restore the NaN the CSV parser gives
+            for col in data.columns[data.dtypes == object]:
+                data[col] = data[col].where(data[col].notna(), np.nan)
+    if data is None:
+        data, encoding = _parse_and_cache(file_path, index, encoding, detected, read_options)
+        if wanted is not None:
+            data = data[[col for col in data.columns if col in wanted]]
+    if detected:
+        _remember_encoding(file_path, encoding, index)
+
+    if dtype is not None:
+        data = data.astype({col: col_dtype for col, col_dtype in dtype.items() if col in data.columns})
+    return data
+
+# Read several exports concurrently and merge them into one frame
+def load_exports(file_paths, columns=None, dtype=None, encoding=DEFAULT_ENCODING, max_workers=None, use_processes=False):
+    file_paths = list(file_paths)
+    if max_workers is None:
+        max_workers = min(len(file_paths), os.cpu_count() or 1) or 1
+
+    # The CSV parser releases the GIL for most of its work, so threads are usually enough
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    reader = partial(read_export, columns=columns, dtype=dtype, encoding=encoding)
+    with executor_class(max_workers=max_workers) as executor:
+        frames = list(executor.map(reader, file_paths))
+
+    # Tag every row with the export it came from
+    for file_path, frame in zip(file_paths, frames):
+        frame.insert(0, SOURCE_COLUMN, file_path)
+
+    return pd.concat(frames, ignore_index=True)
+
+# Get the rows of one export from a merged frame, dropping columns that export does not have
+def export_rows(merged, file_path):
+    rows = merged[merged[SOURCE_COLUMN] == file_path]
+    return rows.dropna(axis=1, how='all')
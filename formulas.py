@@ -0,0 +1,123 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+# One element and its count, e.g. 'C18' or 'Br'; the exports space them out ('C18 H32 O2'), the group files do not
+ELEMENT_PATTERN = re.compile(r'([A-Z][a-z]?)(\d*)')
+FORMULA_PATTERN = re.compile(r'(?:[A-Z][a-z]?\d*)+')
+
+# Columns added by join_groups
+GROUP_FILE_COLUMN = 'Group File'
+GROUP_COLUMN = 'Compound Group'
+
+# Function to parse a formula into element counts; returns None for missing or malformed formulas
+def parse_formula(formula):
+    if not isinstance(formula, str):
+        return None
+    compact = re.sub(r'\s+', '', formula)
+    if not FORMULA_PATTERN.fullmatch(compact):
+        return None
+
+    counts = {}
+    for element, count in ELEMENT_PATTERN.findall(compact):
+        counts[element] = counts.get(element, 0) + (int(count) if count else 1)
+    return counts
+
+# Elements in Hill order: carbon, then hydrogen, then the rest alphabetically (all alphabetical without carbon)
+def hill_order(elements):
+    elements = sorted(elements)
+    if 'C' in elements:
+        elements = ['C'] + (['H'] if 'H' in elements else []) + [e for e in elements if e not in ('C', 'H')]
+    return elements
+
+# Function to normalize a formula to its compact Hill-order form, e.g. 'H32 C18 O2' -> 'C18H32O2'
+def normalize_formula(formula):
+    counts = parse_formula(formula)
+    if not counts:
+        return None
+    return ''.join(f"{element}{counts[element] if counts[element] != 1 else ''}" for element in hill_order(counts))
+
+# Index of a column of formulas: hashed lookups by normalized formula and range queries over element counts
+class FormulaIndex:
+    def __init__(self, formulas):
+        formulas = pd.Series(formulas).reset_index(drop=True)
+
+        # Every distinct spelling is parsed once
+        normalized = {formula: normalize_formula(formula) for formula in formulas.dropna().unique()}
+        keys = formulas.map(normalized)
+
+        # Row positions of every normalized formula
+        self.positions = {key: rows for key, rows in keys.groupby(keys, sort=False).indices.items()}
+        self.formulas = list(self.positions)
+        self.rows = {formula: row for row, formula in enumerate(self.formulas)}
+
+        # Element-count vectors of the distinct formulas, one column per element
+        compositions = [parse_formula(formula) for formula in self.formulas]
+        self.elements = hill_order({element for counts in compositions for element in counts})
+        element_columns = {element: column for column, element in enumerate(self.elements)}
+        self.counts = np.zeros((len(self.formulas), len(self.elements)), dtype=np.int32)
+        for row, counts in enumerate(compositions):
+            for element, count in counts.items():
+                self.counts[row, element_columns[element]] = count
+
+    # Row positions holding a formula, in any spelling
+    def lookup(self, formula):
+        return self.positions.get(normalize_formula(formula), np.empty(0, dtype=np.intp))
+
+    # Element counts of a normalized formula
+    def composition(self, formula):
+        key = normalize_formula(formula)
+        if key not in self.rows:
+            return None
+        return dict(zip(self.elements, self.counts[self.rows[key]].tolist()))
+
+    # Row positions whose counts fall in the given inclusive ranges, e.g. query(C=(18, 22), O=(None, 2))
+    def query(self, **ranges):
+        mask = np.ones(len(self.formulas), dtype=bool)
+        for element, (low, high) in ranges.items():
+            if element in self.elements:
+                counts = self.counts[:, self.elements.index(element)]
+            else:
+                counts = np.zeros(len(self.formulas), dtype=np.int32)
+            if low is not None:
+                mask &= counts >= low
+            if high is not None:
+                mask &= counts <= high
+
+        matches = [self.positions[self.formulas[row]] for row in np.flatnonzero(mask)]
+        if not matches:
+            return np.empty(0, dtype=np.intp)
+        return np.sort(np.concatenate(matches))
+
+# Function to map normalized formulas to the (file, group) pairs that list them
+def group_memberships(file_data):
+    memberships = {}
+    for file, categories in file_data.items():
+        for group, formulas in categories.items():
+            for formula in formulas:
+                key = normalize_formula(formula)
+                if key is not None and (file, group) not in memberships.setdefault(key, []):
+                    memberships[key].append((file, group))
+    return memberships
+
+# Join group membership to the rows of an export; a row appears once per (file, group) listing its formula
+def join_groups(data, file_data, formula_column='Formula'):
+    memberships = group_memberships(file_data)
+    index = FormulaIndex(data[formula_column])
+
+    positions, files, groups = [], [], []
+    for key, rows in index.positions.items():
+        for file, group in memberships.get(key, []):
+            positions.append(rows)
+            files.extend([file] * len(rows))
+            groups.extend([group] * len(rows))
+
+    if not positions:
+        return data.iloc[:0].assign(**{GROUP_FILE_COLUMN: [], GROUP_COLUMN: []})
+    positions = np.concatenate(positions)
+    order = np.argsort(positions, kind='stable')
+    return data.iloc[positions[order]].assign(**{
+        GROUP_FILE_COLUMN: np.asarray(files, dtype=object)[order],
+        GROUP_COLUMN: np.asarray(groups, dtype=object)[order]
+    })
@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+
+# Default tolerance for matching masses across files, in parts per million of the query mass
+DEFAULT_PPM = 5.0
+
+# Index of the masses of an export, sorted once so that any list of query masses can be matched with binary searches
+class MassIndex:
+    def __init__(self, masses, retention_times=None):
+        masses = pd.to_numeric(pd.Series(masses), errors='coerce').to_numpy(dtype=float)
+
+        # Rows without a mass are left out; order maps sorted positions back to rows
+        valid = np.flatnonzero(np.isfinite(masses))
+        self.order = valid[np.argsort(masses[valid], kind='stable')]
+        self.masses = masses[self.order]
+        self.length = len(masses)
+
+        self.retention_times = None
+        if retention_times is not None:
+            retention_times = pd.to_numeric(pd.Series(retention_times), errors='coerce').to_numpy(dtype=float)
+            self.retention_times = retention_times[self.order]
+
+    # Half-width of the matching window around every query mass
+    @staticmethod
+    def tolerance(query_masses, ppm=None, mda=None):
+        if ppm is None and mda is None:
+            ppm = DEFAULT_PPM
+        tolerance = np.zeros(len(query_masses))
+        if ppm is not None:
+            tolerance = np.maximum(tolerance, np.abs(query_masses) * ppm * 1e-6)
+        if mda is not None:
+            tolerance = np.maximum(tolerance, mda * 1e-3)
+        return tolerance
+
+    # Matching pairs as query positions and sorted positions of the index
+    def _match_positions(self, query_masses, ppm, mda, query_retention_times, rt_window):
+        tolerance = self.tolerance(query_masses, ppm, mda)
+
+        # Range of sorted positions within the window of every query; missing query masses match nothing
+        low = np.searchsorted(self.masses, query_masses - tolerance, side='left')
+        high = np.searchsorted(self.masses, query_masses + tolerance, side='right')
+        counts = np.where(np.isfinite(query_masses), high - low, 0)
+
+        # Expand the ranges into one entry per pair
+        queries = np.repeat(np.arange(len(query_masses)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        positions = low[queries] + offsets
+
+        if rt_window is not None:
+            if self.retention_times is None or query_retention_times is None:
+                raise ValueError("rt_window needs retention times for both the index and the queries")
+            query_retention_times = pd.to_numeric(pd.Series(query_retention_times), errors='coerce').to_numpy(dtype=float)
+            within = np.abs(self.retention_times[positions] - query_retention_times[queries]) <= rt_window
+            queries, positions = queries[within], positions[within]
+        return queries, positions
+
+    # Every (query, row) pair whose masses agree within the tolerance, and retention times within rt_window if given
+    def match(self, query_masses, ppm=None, mda=None, query_retention_times=None, rt_window=None):
+        query_masses = pd.to_numeric(pd.Series(query_masses), errors='coerce').to_numpy(dtype=float)
+        queries, positions = self._match_positions(query_masses, ppm, mda, query_retention_times, rt_window)
+        return queries, self.order[positions]
+
+    # Mask of the indexed rows matched by any of the query masses
+    def contains(self, query_masses, ppm=None, mda=None, query_retention_times=None, rt_window=None):
+        _, rows = self.match(query_masses, ppm, mda, query_retention_times, rt_window)
+        mask = np.zeros(self.length, dtype=bool)
+        mask[rows] = True
+        return mask
+
+    # Closest indexed row of every query mass within the tolerance, or -1 if there is none
+    def nearest(self, query_masses, ppm=None, mda=None, query_retention_times=None, rt_window=None):
+        query_masses = pd.to_numeric(pd.Series(query_masses), errors='coerce').to_numpy(dtype=float)
+        queries, positions = self._match_positions(query_masses, ppm, mda, query_retention_times, rt_window)
+        nearest = np.full(len(query_masses), -1, dtype=np.intp)
+        if len(queries) == 0:
+            return nearest
+
+        # Order the pairs by query then mass error, and keep the first pair of every query
+        order = np.lexsort((np.abs(self.masses[positions] - query_masses[queries]), queries))
+        queries, positions = queries[order], positions[order]
+        first = np.r_[True, queries[1:] != queries[:-1]]
+        nearest[queries[first]] = self.order[positions[first]]
+        return nearest
@@ -1,12 +1,21 @@
 import dash
 import dash_bootstrap_components as dbc
 from dash import dcc, html, dash_table
-from dash.dependencies import Input, Output
+from dash.dependencies import ALL, MATCH, Input, Output, State
+import numpy as np
 import pandas as pd
 
+from exports import read_export
+
 # Initialize the Dash app
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
 
+# Build a pathway table only when its pathway is expanded, instead of rendering every table up front
+LAZY_RENDERING = True
+
+# Rows per page of a table in lazy mode
+PAGE_SIZE = 50
+
 # Define necessary columns
 additional_columns = ['Calc. MW', 'm/z']
 adj_p_columns = [
@@ -24,21 +33,13 @@ p_columns = [
 
 # Load data from CSV and preprocess it
 def load_and_preprocess_data(filepath):
-    data = pd.read_csv(filepath, encoding='ISO-8859-1', on_bad_lines='skip')
+    data = read_export(filepath, on_bad_lines='skip')
     data.columns = data.columns.str.strip().str.replace('"', '')
 
     # Assign identifier based on the presence of Formula, Name, or Calc. MW
-    def assign_identifier(row):
-        if pd.notna(row['Formula']):
-            return row['Formula']
-        elif pd.notna(row['Name']):
-            return row['Name']
-        elif pd.notna(row['Calc. MW']):
-            return str(row['Calc. MW'])
-        else:
-            return None
-
-    data['Identifier'] = data.apply(assign_identifier, axis=1)
+    calc_mw_text = data['Calc. MW'].astype(str).where(data['Calc. MW'].notna())
+    identifier = data['Formula'].astype(object).fillna(data['Name']).fillna(calc_mw_text)
+    data['Identifier'] = identifier.where(identifier.notna(), None)
     
     # Ensure numeric conversion for p_value columns
     for col in additional_columns + p_columns + adj_p_columns:
@@ -59,9 +60,31 @@ def load_and_preprocess_data(filepath):
     data['BioCyc Pathways'] = data['BioCyc Pathways'].str.strip()
     data['BioCyc Pathways'] = data['BioCyc Pathways'].str.replace('special_pathway', 'γ-linolenate biosynthesis II (animals)')
 
+    # Colour class of every comparison, stored in a hidden column the table styles by
+    for p_col, adj_p_col in zip(p_columns, adj_p_columns):
+        data[f'{adj_p_col}_color'] = np.select(
+            [data[adj_p_col] < 0.05, data[p_col] < 0.05], ['green', 'yellow'], default='red'
+        )
+
     return data
 
+# Map every pathway to the positions of its rows, sorted by Calc. MW, once with and once without the insignificant rows
+def build_pathway_index(data):
+    # A row is insignificant when none of its adjusted p-values is below 0.05
+    all_insignificant = ~(data[adj_p_columns] < 0.05).any(axis=1).to_numpy()
+    calc_mw = data['Calc. MW'].to_numpy()
+
+    pathway_index = {}
+    for pathway, positions in data.groupby('BioCyc Pathways', sort=False).indices.items():
+        significant_positions = positions[~all_insignificant[positions]]
+        pathway_index[pathway] = {
+            hide_red: pd.Series(calc_mw[rows], index=rows).sort_values().index.to_numpy()
+            for hide_red, rows in ((False, positions), (True, significant_positions))
+        }
+    return pathway_index
+
 data = load_and_preprocess_data('BioCycWorkflow.csv')
+pathway_index = build_pathway_index(data)
 
 # Identify unique pathways
 unique_pathways = data['BioCyc Pathways'].unique()
@@ -76,70 +99,53 @@ def format_to_scientific(value):
             return value
     return value
 
-# Function to check if a row has all red p-value cells
-def has_all_red_cells(row):
-    for adj_p_col in adj_p_columns:
-        adj_p_value = pd.to_numeric(row[adj_p_col], errors='coerce')
-        if pd.notna(adj_p_value) and adj_p_value < 0.05:
-            return False
-    return True
+# One condition per comparison and colour, matched against the hidden colour columns
+style_conditions = [
+    {
+        'if': {'filter_query': f'{{{adj_p_col}_color}} = "{color}"', 'column_id': adj_p_col},
+        'backgroundColor': color,
+        'color': 'white' if color in ['red', 'green'] else 'black'
+    }
+    for adj_p_col in adj_p_columns
+    for color in ['green', 'yellow', 'red']
+]
+
+# Columns shown in every pathway table; the colour columns are sent along but not displayed
+table_columns = [
+    {"name": "Identifier", "id": "Identifier"},
+    {"name": "Calc. MW", "id": "Calc. MW"},
+    {"name": "m/z", "id": "m/z"}
+] + [{"name": col, "id": col} for col in adj_p_columns]
+record_columns = [column["id"] for column in table_columns] + [f'{col}_color' for col in adj_p_columns]
+
+# Format rows of a pathway as table records, with the adjusted p-values in scientific notation
+def format_pathway_rows(pathway_data):
+    formatted_data = pathway_data[record_columns].copy()
+    for col in adj_p_columns:
+        formatted_data[col] = formatted_data[col].apply(format_to_scientific)
+    return formatted_data.to_dict('records')
+
+# Create a pathway table from formatted records
+def create_pathway_table(records, **table_options):
+    return dash_table.DataTable(
+        columns=table_columns,
+        data=records,
+        style_table={'overflowX': 'auto', 'minWidth': '100%'},
+        style_cell={'textAlign': 'center', 'minWidth': '100px', 'maxWidth': '150px', 'whiteSpace': 'normal'},
+        style_header={'backgroundColor': 'rgb(230, 230, 230)', 'fontWeight': 'bold'},
+        style_data_conditional=style_conditions,
+        **table_options
+    )
 
 # Generate the tables for each pathway
-def generate_tables_for_pathways(data, pathways, hide_red):
+def generate_tables_for_pathways(data, pathway_index, pathways, hide_red):
     tables = []
     for pathway in pathways:
-        pathway_data = data[data['BioCyc Pathways'] == pathway]
-
-        if hide_red:
-            pathway_data = pathway_data[~pathway_data.apply(has_all_red_cells, axis=1)]
-
-        pathway_data = pathway_data.sort_values(by='Calc. MW')
-
-        # Generate the table columns
-        columns = [
-            {"name": "Identifier", "id": "Identifier"},
-            {"name": "Calc. MW", "id": "Calc. MW"},
-            {"name": "m/z", "id": "m/z"}
-        ] + [{"name": col, "id": col} for col in adj_p_columns]
-
-        # Apply scientific notation formatting to the adj_p_columns
-        formatted_data = pathway_data.copy()
-        for col in adj_p_columns:
-            formatted_data[col] = formatted_data[col].apply(format_to_scientific)
-
-        # Generate style conditions
-        style_conditions = []
-        for i, row in formatted_data.iterrows():
-            for p_col, adj_p_col in zip(p_columns, adj_p_columns):
-                try:
-                    adj_p_value = float(row[adj_p_col])
-                    p_value = float(row[p_col])
-                    if pd.notna(adj_p_value) and adj_p_value < 0.05:
-                        color = 'green'
-                    elif pd.notna(p_value) and p_value < 0.05:
-                        color = 'yellow'
-                    else:
-                        color = 'red'
-                    text_color = 'white' if color in ['red', 'green'] else 'black'
-                    style_conditions.append({
-                        'if': {
-                            'filter_query': f'{{Identifier}} = "{row["Identifier"]}" && {{{adj_p_col}}} = "{row[adj_p_col]}"',
-                            'column_id': adj_p_col
-                        },
-                        'backgroundColor': color,
-                        'color': text_color
-                    })
-                except (ValueError, TypeError):
-                    continue
-
-        # Create the table
-        table = dash_table.DataTable(
-            columns=columns,
-            data=formatted_data.to_dict('records'),
-            style_table={'overflowX': 'auto', 'minWidth': '100%'},
-            style_cell={'textAlign': 'center', 'minWidth': '100px', 'maxWidth': '150px', 'whiteSpace': 'normal'},
-            style_header={'backgroundColor': 'rgb(230, 230, 230)', 'fontWeight': 'bold'},
-            style_data_conditional=style_conditions,
+        # The rows of every pathway were grouped and sorted by Calc. MW when the data was loaded
+        pathway_data = data.iloc[pathway_index[pathway][hide_red]]
+
+        table = create_pathway_table(
+            format_pathway_rows(pathway_data),
             page_size=len(pathway_data)  # Display all rows on one page
         )
         tables.append(html.Div([
@@ -148,6 +154,35 @@ def generate_tables_for_pathways(data, pathways, hide_red):
         ]))
     return tables
 
+# Generate the table of one pathway in lazy mode; only the first page is sent, the rest is paged on demand
+def generate_lazy_table(data, pathway_index, pathway_id, hide_red):
+    rows = pathway_index[unique_pathways[pathway_id]][hide_red]
+    return create_pathway_table(
+        format_pathway_rows(data.iloc[rows[:PAGE_SIZE]]),
+        id={'type': 'pathway-table', 'index': pathway_id},
+        page_action='custom',
+        page_current=0,
+        page_size=PAGE_SIZE,
+        page_count=max(1, -(-len(rows) // PAGE_SIZE))
+    )
+
+# In lazy mode the pathways are listed in an accordion and a table is only built when its pathway is expanded
+if LAZY_RENDERING:
+    tables_container = dbc.Accordion(
+        [
+            dbc.AccordionItem(
+                html.Div(id={'type': 'pathway-container', 'index': pathway_id}),
+                title=pathway,
+                item_id=str(pathway_id)
+            )
+            for pathway_id, pathway in enumerate(unique_pathways)
+        ],
+        id='pathway-accordion',
+        start_collapsed=True
+    )
+else:
+    tables_container = html.Div(id='tables-container')
+
 # Layout of the app
 app.layout = dbc.Container(
     [
@@ -158,22 +193,56 @@ app.layout = dbc.Container(
             )
         ),
         dbc.Row(dbc.Col(html.H1("Significant Compound Pathway Tables", className="text-center text-primary mb-4", style={"font-weight": "bold"}), width=12)),
-        html.Div(id='tables-container')
+        tables_container
     ],
     fluid=True,
     style={"backgroundColor": "#f8f9fa", "padding": "20px"}
 )
 
-# Callback to update the table and button text
-@app.callback(
-    [Output("tables-container", "children"),
-     Output("toggle-red-rows", "children")],
-    [Input('toggle-red-rows', 'n_clicks')]
-)
-def update_tables(n_clicks):
-    hide_red = (n_clicks is not None) and (n_clicks % 2 == 1)
-    button_text = "Include insignificant rows" if hide_red else "Exclude insignificant rows"
-    return generate_tables_for_pathways(data, unique_pathways, hide_red), button_text
+if LAZY_RENDERING:
+    # Callback to build the table of the expanded pathway and update the button text
+    @app.callback(
+        [Output({'type': 'pathway-container', 'index': ALL}, 'children'),
+         Output("toggle-red-rows", "children")],
+        [Input('pathway-accordion', 'active_item'),
+         Input('toggle-red-rows', 'n_clicks')]
+    )
+    def update_active_table(active_item, n_clicks):
+        hide_red = (n_clicks is not None) and (n_clicks % 2 == 1)
+        button_text = "Include insignificant rows" if hide_red else "Exclude insignificant rows"
+
+        # Collapsed pathways are emptied so only the expanded table stays in the page
+        children = [None] * len(unique_pathways)
+        if active_item is not None:
+            pathway_id = int(active_item)
+            children[pathway_id] = generate_lazy_table(data, pathway_index, pathway_id, hide_red)
+        return children, button_text
+
+    # Callback to serve one page of a pathway table
+    @app.callback(
+        Output({'type': 'pathway-table', 'index': MATCH}, 'data'),
+        [Input({'type': 'pathway-table', 'index': MATCH}, 'page_current'),
+         Input({'type': 'pathway-table', 'index': MATCH}, 'page_size')],
+        [State({'type': 'pathway-table', 'index': MATCH}, 'id'),
+         State('toggle-red-rows', 'n_clicks')],
+        prevent_initial_call=True
+    )
+    def update_page(page_current, page_size, table_id, n_clicks):
+        hide_red = (n_clicks is not None) and (n_clicks % 2 == 1)
+        rows = pathway_index[unique_pathways[table_id['index']]][hide_red]
+        start = (page_current or 0) * page_size
+        return format_pathway_rows(data.iloc[rows[start:start + page_size]])
+else:
+    # Callback to update the table and button text
+    @app.callback(
+        [Output("tables-container", "children"),
+         Output("toggle-red-rows", "children")],
+        [Input('toggle-red-rows', 'n_clicks')]
+    )
+    def update_tables(n_clicks):
+        hide_red = (n_clicks is not None) and (n_clicks % 2 == 1)
+        button_text = "Include insignificant rows" if hide_red else "Exclude insignificant rows"
+        return generate_tables_for_pathways(data, pathway_index, unique_pathways, hide_red), button_text
 
 if __name__ == '__main__':
     app.run_server(debug=True)
\ No newline at end of file
@@ -1,80 +1,77 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+
 import dash
 import dash_bootstrap_components as dbc
 from dash import dcc, html, dash_table
 from dash.dependencies import Input, Output, State
+import numpy as np
 import pandas as pd
+from flask import request
+
+from exports import read_export
 
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
 
-# Define necessary columns
-ratio_columns = [
-    'Ratio: (cla) / (ctrl)',
-    'Ratio: (cla/lps) / (ctrl)',
-    'Ratio: (lps) / (ctrl)',
-    'Ratio: (no2-cla/lps) / (ctrl)'
-]
-
-p_columns = [
-    'P-value: (cla) / (ctrl)',
-    'P-value: (cla/lps) / (ctrl)',
-    'P-value: (lps) / (ctrl)',
-    'P-value: (no2-cla/lps) / (ctrl)'
-]
-
-adj_p_columns = [
-    'Adj. P-value: (cla) / (ctrl)',
-    'Adj. P-value: (cla/lps) / (ctrl)',
-    'Adj. P-value: (lps) / (ctrl)',
-    'Adj. P-value: (no2-cla/lps) / (ctrl)'
-]
+# Rows per page; paging, sorting and filtering are done on the server
+PAGE_SIZE = 50
+
+# Directory of this script; the dataset paths below are relative to it
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Datasets served by the app: path, decimals of Calc. MW and m/z, and whether those columns show by default
+DATASETS = {
+    'AdjustedWorkflow': {'path': os.path.join(BASE_DIR, 'AdjustedWorkflow.csv'), 'precision': 1, 'show_additional': False},
+    'no2-cla_ctrl': {'path': os.path.join(BASE_DIR, 'VolcanoPlots', 'no2-cla_ctrl.csv'), 'precision': 4, 'show_additional': True},
+}
+
+# Memory the preprocessed datasets may use together before the least recently used ones are dropped
+CACHE_MEMORY_BUDGET = 512 * 1024 ** 2
 
 additional_columns = ['Calc. MW', 'm/z']
 
+# Detect the comparisons that have a ratio, a p-value and an adjusted p-value column
+def detect_columns(columns):
+    available = set(columns)
+    comparisons = [
+        comparison for comparison in (col.replace('Ratio: ', '', 1) for col in columns if col.startswith('Ratio: '))
+        if f'P-value: {comparison}' in available and f'Adj. P-value: {comparison}' in available
+    ]
+    return (
+        [f'Ratio: {comparison}' for comparison in comparisons],
+        [f'P-value: {comparison}' for comparison in comparisons],
+        [f'Adj. P-value: {comparison}' for comparison in comparisons]
+    )
+
 # Load data from CSV and preprocess it
-def load_and_preprocess_data(filepath):
-    data = pd.read_csv(filepath, encoding='ISO-8859-1', on_bad_lines='skip')
+def load_and_preprocess_data(filepath, precision=1):
+    data = read_export(filepath, on_bad_lines='skip')
     data.columns = data.columns.str.strip().str.replace('"', '')
+    ratio_columns, p_columns, adj_p_columns = detect_columns(data.columns)
 
     # Assign identifier based on the presence of Formula, Name, or Calc. MW
-    def assign_identifier(row):
-        if pd.notna(row['Formula']):
-            return row['Formula']
-        elif pd.notna(row['Name']):
-            return row['Name']
-        elif pd.notna(row['Calc. MW']):
-            return str(row['Calc. MW'])
-        else:
-            return None
-
-    data['Identifier'] = data.apply(assign_identifier, axis=1)
+    calc_mw_text = data['Calc. MW'].astype(str).where(data['Calc. MW'].notna())
+    identifier = data['Formula'].astype(object).fillna(data['Name']).fillna(calc_mw_text)
+    data['Identifier'] = identifier.where(identifier.notna(), None)
     data['Used Calc MW'] = data['Identifier'] == data['Calc. MW'].astype(str)
     
     # Ensure numeric conversion for ratio, p_value, and adj_p_value columns
     for col in ratio_columns + p_columns + adj_p_columns:
         data[col] = pd.to_numeric(data[col], errors='coerce')
 
-    # Round the additional columns to one decimal place
+    # Round the additional columns to the precision of the dataset
     for col in additional_columns:
-        data[col] = data[col].round(1)
+        data[col] = data[col].round(precision)
 
     # Filter the data based on ratio conditions
-    filtered_data = data[
-        (data[ratio_columns[0]] < 0.8) | (data[ratio_columns[0]] > 1.25) |
-        (data[ratio_columns[1]] < 0.8) | (data[ratio_columns[1]] > 1.25) |
-        (data[ratio_columns[2]] < 0.8) | (data[ratio_columns[2]] > 1.25) |
-        (data[ratio_columns[3]] < 0.8) | (data[ratio_columns[3]] > 1.25)
-    ]
+    ratios = data[ratio_columns].to_numpy()
+    filtered_data = data[((ratios < 0.8) | (ratios > 1.25)).any(axis=1)]
 
     # Exclude compounds with only red cells
-    def has_non_red_cell(row):
-        for p_col, adj_p_col in zip(p_columns, adj_p_columns):
-            p_value = row[p_col]
-            adj_p_value = row[adj_p_col]
-            if (pd.notna(adj_p_value) and adj_p_value <= 0.05) or (pd.notna(p_value) and p_value <= 0.05):
-                return True
-        return False
-
-    filtered_data = filtered_data[filtered_data.apply(has_non_red_cell, axis=1)]
+    has_non_red_cell = (filtered_data[adj_p_columns].to_numpy() <= 0.05) | (filtered_data[p_columns].to_numpy() <= 0.05)
+    filtered_data = filtered_data[has_non_red_cell.any(axis=1)]
 
     # Convert Identifier column to string to ensure consistent sorting
     filtered_data['Identifier'] = filtered_data['Identifier'].astype(str)
@@ -84,65 +81,185 @@ def load_and_preprocess_data(filepath):
 
     # Add a new display column combining p-value and adj p-value with spaces around '/'
     for p_col, adj_p_col in zip(p_columns, adj_p_columns):
-        filtered_data[f'{p_col}_display'] = filtered_data.apply(lambda row: f"{row[p_col]:.1e} / {row[adj_p_col]:.1e}", axis=1)
-
-    return filtered_data
-
-data = load_and_preprocess_data('AdjustedWorkflow.csv')
-
-# Define the color logic to be used in style_data_conditional
-def generate_style_conditions(filtered_data):
-    conditions = []
-    for i, compound in filtered_data.iterrows():
-        for p_col, adj_p_col in zip(p_columns, adj_p_columns):
-            adj_p_value = pd.to_numeric(compound[adj_p_col], errors='coerce')
-            p_value = pd.to_numeric(compound[p_col], errors='coerce')
-            if pd.notna(adj_p_value) and adj_p_value <= 0.05:
-                color = 'green'
-                text_color = 'white'
-            elif pd.notna(p_value) and p_value <= 0.05:
-                color = 'yellow'
-                text_color = 'black'
-            else:
-                color = 'red'
-                text_color = 'red'
-            conditions.append({
-                'if': {
-                    'filter_query': f'{{Identifier}} = "{compound["Identifier"]}" && {{{p_col}_display}} = "{compound[f"{p_col}_display"]}"',
-                    'column_id': f'{p_col}_display'
-                },
-                'backgroundColor': color,
-                'color': text_color
-            })
-    return conditions
-
-# Layout of the app
-app.layout = dbc.Container(
-    [
-        dbc.Row(
-            dbc.Col(
-                html.Button("Show/Hide", id="toggle-columns", className="btn btn-primary mb-4", style={"margin": "20px"}),
-                width=12
-            )
-        ),
-        dbc.Row(dbc.Col(html.H1("Significant Compound Comparison", className="text-center text-primary mb-4", style={"font-weight": "bold"}), width=12)),
-        dbc.Row(dbc.Col(dcc.Loading(id="loading", children=[html.Div(id="compounds-table")], type="default"), width=12))
-    ],
-    fluid=True,
-    style={"backgroundColor": "#f8f9fa", "padding": "20px"}
-)
+        filtered_data[f'{p_col}_display'] = np.char.add(
+            np.char.mod('%.1e / ', filtered_data[p_col].to_numpy()),
+            np.char.mod('%.1e', filtered_data[adj_p_col].to_numpy())
+        ).astype(object)
+
+    # Colour class of every comparison, stored in a hidden column the table styles by
+    for p_col, adj_p_col in zip(p_columns, adj_p_columns):
+        filtered_data[f'{p_col}_color'] = np.select(
+            [filtered_data[adj_p_col] <= 0.05, filtered_data[p_col] <= 0.05], ['green', 'yellow'], default='red'
+        )
+
+    return filtered_data, p_columns
+
+# Sort keys of every sortable column as dense ranks; the display columns sort by their p-value
+def build_sort_keys(filtered_data, p_columns):
+    key_columns = {col: col for col in ['Identifier'] + additional_columns}
+    key_columns.update({f'{p_col}_display': p_col for p_col in p_columns})
+    return {col_id: filtered_data[col].rank(method='dense').to_numpy() for col_id, col in key_columns.items()}
+
+# Preprocessed datasets shared by all callbacks, most recently used last; each is reloaded only when its file changes
+dataset_cache = OrderedDict()
+dataset_lock = threading.Lock()
+
+# Memory used by a cached dataset
+def dataset_memory(entry):
+    return int(entry['data'].memory_usage(deep=True).sum()) + sum(keys.nbytes for keys in entry['sort_keys'].values())
+
+# Get the preprocessed data, comparisons and sort keys of a dataset, reparsing it only if its size or mtime changed
+def get_dataset(name, force_reload=False):
+    config = DATASETS[name]
+    stat = os.stat(config['path'])
+    with dataset_lock:
+        entry = dataset_cache.get(name)
+        if force_reload or entry is None or (entry['size'], entry['mtime_ns']) != (stat.st_size, stat.st_mtime_ns):
+            filtered_data, p_columns = load_and_preprocess_data(config['path'], config['precision'])
+            entry = {
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'data': filtered_data,
+                'p_columns': p_columns,
+                'sort_keys': build_sort_keys(filtered_data, p_columns)
+            }
+            entry['memory'] = dataset_memory(entry)
+            dataset_cache[name] = entry
+        dataset_cache.move_to_end(name)
 
-# Callback to update the table
+        # Drop the least recently used datasets once over budget, always keeping the one just requested
+        while len(dataset_cache) > 1 and sum(cached['memory'] for cached in dataset_cache.values()) > CACHE_MEMORY_BUDGET:
+            dataset_cache.popitem(last=False)
+    return entry
+
+# Drop and reparse cached datasets, e.g. after an export was replaced with a file of the same size and mtime
+def reload_dataset(name=None):
+    names = [name] if name is not None else list(dataset_cache)
+    return {name: get_dataset(name, force_reload=True) for name in names}
+
+# One condition per comparison and colour, matched against the hidden colour columns
+text_colors = {'green': 'white', 'yellow': 'black', 'red': 'red'}
+def generate_style_conditions(p_columns):
+    return [
+        {
+            'if': {'filter_query': f'{{{p_col}_color}} = "{color}"', 'column_id': f'{p_col}_display'},
+            'backgroundColor': color,
+            'color': text_color
+        }
+        for p_col in p_columns
+        for color, text_color in text_colors.items()
+    ]
+
+# Filter expressions sent by the table, e.g. {Identifier} contains "C18" or {Calc. MW} s>= 300
+filter_pattern = re.compile(r'^\{(?P<column>[^}]+)\}\s*(?P<operator>[is]?(?:>=|<=|!=|<|>|=|eq|ne|lt|le|gt|ge|contains|datestartswith))\s*(?P<value>.*)$')
+operator_aliases = {'eq': '=', 'ne': '!=', 'lt': '<', 'le': '<=', 'gt': '>', 'ge': '>='}
+
+# Split one filter expression into column, operator, value and whether the comparison ignores case
+def split_filter_part(filter_part):
+    match = filter_pattern.match(filter_part.strip())
+    if match is None:
+        return None, None, None, False
+    # 'i' makes the comparison case-insensitive; 's' is the default, case-sensitive one
+    case_insensitive = match['operator'].startswith('i')
+    operator = match['operator'].lstrip('is')
+    operator = operator_aliases.get(operator, operator)
+
+    # The value stays text; filter_mask converts it to the type of the column it is compared with
+    value = match['value'].strip()
+    if len(value) > 1 and value[0] == value[-1] and value[0] in ('"', "'", '`'):
+        value = value[1:-1].replace('\\' + value[0], value[0])
+    return match['column'], operator, value, case_insensitive
+
+# Mask of the rows matching a filter query; numeric conditions on a display column apply to its p-value
+def filter_mask(filtered_data, sort_keys, filter_query):
+    mask = np.ones(len(filtered_data), dtype=bool)
+    for filter_part in (filter_query or '').split(' && '):
+        column, operator, value, case_insensitive = split_filter_part(filter_part)
+        if column not in sort_keys:
+            continue
+        if operator in ('contains', 'datestartswith'):
+            text = filtered_data[column].astype(str)
+            if case_insensitive:
+                text, value = text.str.lower(), value.lower()
+            matches = text.str.contains(value, regex=False) if operator == 'contains' else text.str.startswith(value)
+            mask &= matches.to_numpy() & filtered_data[column].notna().to_numpy()
+            continue
+
+        values = filtered_data[column[:-len('_display')] if column.endswith('_display') else column]
+        present = values.notna().to_numpy()
+        if pd.api.types.is_numeric_dtype(values):
+            # A value that is not a number matches no row of a numeric column
+            try:
+                value = float(value)
+            except ValueError:
+                mask[:] = False
+                continue
+        else:
+            # Text columns compare as text; missing cells match nothing
+            values = values.where(present, '').astype(str)
+            if case_insensitive:
+                values, value = values.str.lower(), value.lower()
+            mask &= present
+        comparisons = {
+            '=': values.__eq__, '!=': values.__ne__, '<': values.__lt__,
+            '<=': values.__le__, '>': values.__gt__, '>=': values.__ge__
+        }
+        mask &= comparisons[operator](value).to_numpy()
+    return mask
+
+# Row positions in the order requested by the table; missing values always sort last
+def sorted_positions(sort_keys, positions, sort_by):
+    keys = []
+    for sort in reversed(sort_by or []):
+        ranks = sort_keys[sort['column_id']][positions]
+        keys.append(np.where(np.isnan(ranks), np.inf, ranks if sort['direction'] == 'asc' else -ranks))
+    if not keys:
+        return positions
+    return positions[np.lexsort(keys)]
+
+# Layout of the app, opening on the given dataset
+def serve_layout(default_dataset=None):
+    return dbc.Container(
+        [
+            dbc.Row(
+                [
+                    dbc.Col(
+                        html.Button("Show/Hide", id="toggle-columns", className="btn btn-primary mb-4", style={"margin": "20px"}),
+                        width="auto"
+                    ),
+                    dbc.Col(
+                        dcc.Dropdown(
+                            id='dataset-select',
+                            options=[{'label': name, 'value': name} for name in DATASETS],
+                            value=default_dataset or next(iter(DATASETS)),
+                            clearable=False,
+                            style={"margin": "20px", "minWidth": "300px"}
+                        ),
+                        width="auto"
+                    )
+                ]
+            ),
+            dbc.Row(dbc.Col(html.H1("Significant Compound Comparison", className="text-center text-primary mb-4", style={"font-weight": "bold"}), width=12)),
+            dbc.Row(dbc.Col(dcc.Loading(id="loading", children=[html.Div(id="compounds-table")], type="default"), width=12))
+        ],
+        fluid=True,
+        style={"backgroundColor": "#f8f9fa", "padding": "20px"}
+    )
+
+app.layout = serve_layout()
+
+# Callback to update the table; its rows are served page by page by update_page
 @app.callback(
     Output("compounds-table", "children"),
-    [Input('loading', 'children'), Input('toggle-columns', 'n_clicks')],
+    [Input('loading', 'children'), Input('toggle-columns', 'n_clicks'), Input('dataset-select', 'value')],
     [State('loading', 'children')]
 )
-def update_table(_, n_clicks, __):
-    filtered_data = load_and_preprocess_data('AdjustedWorkflow.csv')
-    display_columns = [f"{col}_display" for col in p_columns]
-    
-    show_additional_columns = (n_clicks is not None) and (n_clicks % 2 == 1)
+def update_table(_, n_clicks, dataset_name, __):
+    p_columns = get_dataset(dataset_name)['p_columns']
+
+    # Each click flips the dataset's default
+    toggled = (n_clicks is not None) and (n_clicks % 2 == 1)
+    show_additional_columns = DATASETS[dataset_name]['show_additional'] != toggled
     
     columns = [{"name": "Identifier", "id": "Identifier"}]
     
@@ -152,14 +269,48 @@ def update_table(_, n_clicks, __):
     columns += [{"name": col, "id": f"{col}_display"} for col in p_columns]
     
     return dash_table.DataTable(
+        id='compounds-datatable',
         columns=columns,
-        data=filtered_data[['Identifier'] + (additional_columns if show_additional_columns else []) + display_columns].to_dict('records'),
         style_table={'overflowX': 'auto', 'minWidth': '100%'},
         style_cell={'textAlign': 'center', 'minWidth': '150px', 'maxWidth': '200px', 'whiteSpace': 'normal'},
         style_header={'backgroundColor': 'rgb(230, 230, 230)', 'fontWeight': 'bold'},
-        style_data_conditional=generate_style_conditions(filtered_data),
-        page_size=len(filtered_data)  # Display all rows on one page
+        style_data_conditional=generate_style_conditions(p_columns),
+        page_action='custom',
+        page_current=0,
+        page_size=PAGE_SIZE,
+        sort_action='custom',
+        sort_mode='multi',
+        sort_by=[],
+        filter_action='custom',
+        filter_query=''
     )
 
+# Callback to filter, sort and slice the rows of the visible page
+@app.callback(
+    [Output('compounds-datatable', 'data'),
+     Output('compounds-datatable', 'page_count')],
+    [Input('compounds-datatable', 'page_current'),
+     Input('compounds-datatable', 'page_size'),
+     Input('compounds-datatable', 'sort_by'),
+     Input('compounds-datatable', 'filter_query')],
+    [State('dataset-select', 'value')]
+)
+def update_page(page_current, page_size, sort_by, filter_query, dataset_name):
+    dataset = get_dataset(dataset_name)
+    data, p_columns = dataset['data'], dataset['p_columns']
+    positions = sorted_positions(dataset['sort_keys'], np.flatnonzero(filter_mask(data, dataset['sort_keys'], filter_query)), sort_by)
+    start = (page_current or 0) * page_size
+    record_columns = ['Identifier'] + additional_columns + [f"{col}_display" for col in p_columns] + [f"{col}_color" for col in p_columns]
+    page = data.iloc[positions[start:start + page_size]][record_columns]
+    return page.to_dict('records'), max(1, -(-len(positions) // page_size))
+
+# Reload hook for scripts that update an export in place; reloads every cached dataset unless one is named
+@app.server.route('/reload', methods=['POST'])
+def reload_route():
+    name = request.args.get('dataset')
+    if name is not None and name not in DATASETS:
+        return {'error': f'Unknown dataset: {name}'}, 404
+    return {name: len(entry['data']) for name, entry in reload_dataset(name).items()}
+
 if __name__ == '__main__':
     app.run_server(debug=True)
@@ -1,14 +1,35 @@
+import gzip
+import hashlib
+import json
 import os
-from flask import Flask, render_template, jsonify
+import threading
+import time
+from flask import Flask, Response, render_template, request
+import numpy as np
 import pandas as pd
 
 app = Flask(__name__)
 
-# Step 1: Identify and filter .txt files by their modification date
-directory = '/Users/matias/Documents/GitHub/LabTools'
-files = [f for f in os.listdir(directory) if f.endswith('.txt') and '(' in f and ')' in f]
-files.sort(key=lambda x: os.path.getmtime(os.path.join(directory, x)), reverse=True)
-selected_files = files[:4]
+# Directory holding the group files (set LABTOOLS_GROUPS_DIR to use another one)
+directory = os.environ.get('LABTOOLS_GROUPS_DIR', os.path.dirname(os.path.abspath(__file__)))
+
+# Seconds between two checks of the directory for new, changed or removed files
+POLL_INTERVAL = 2.0
+
+# Number of files compared when the client does not choose any
+DEFAULT_FILE_COUNT = 4
+
+# Step 1: Identify the group .txt files with their modification date and size
+def list_group_files():
+    files = {}
+    for f in os.listdir(directory):
+        if f.endswith('.txt') and '(' in f and ')' in f:
+            try:
+                stat = os.stat(os.path.join(directory, f))
+            except FileNotFoundError:
+                continue  # Removed while listing
+            files[f] = (stat.st_mtime_ns, stat.st_size)
+    return files
 
 # Step 2: Parse the chemical formulas and categories from the files
 def parse_file(file_path):
@@ -22,40 +43,157 @@ def parse_file(file_path):
             categories[category.strip()] = formulas
     return categories
 
-file_data = {file: parse_file(os.path.join(directory, file)) for file in selected_files}
-
-# Step 3: Get all unique formulas and compound groups
-all_formulas = set()
-compound_groups = set()
-for categories in file_data.values():
-    for group, formulas in categories.items():
-        all_formulas.update(formulas)
-        compound_groups.add(group)
-
-formulas_list = sorted(all_formulas)
-compound_groups = sorted(compound_groups)
-
-# Step 4: Function to generate table data
-def generate_table_data(selected_group):
-    table_data = []
-    for formula in formulas_list:
-        row = []
-        for file in selected_files:
-            found = False
-            if selected_group in file_data[file] and formula in file_data[file][selected_group]:
-                found = True
-            row.append(1 if found else 0)
-        table_data.append(row)
-    return table_data
+# Step 3: Build the group index: all formulas and groups, and a formula x file presence matrix per group
+def build_index(file_stats, file_data, version, failed=None):
+    # Newest files first
+    files = sorted(file_data, key=lambda f: file_stats[f][0], reverse=True)
+
+    all_formulas = set()
+    compound_groups = set()
+    for categories in file_data.values():
+        for group, formulas in categories.items():
+            all_formulas.update(formulas)
+            compound_groups.add(group)
+
+    formulas_list = sorted(all_formulas)
+    formula_positions = {formula: position for position, formula in enumerate(formulas_list)}
+
+    presence_matrices = {}
+    for group in compound_groups:
+        matrix = np.zeros((len(formulas_list), len(files)), dtype=np.uint8)
+        for column, file in enumerate(files):
+            rows = [formula_positions[formula] for formula in set(file_data[file].get(group, []))]
+            matrix[rows, column] = 1
+        presence_matrices[group] = matrix
+
+    return {
+        'version': version,
+        'file_stats': file_stats,
+        'file_data': file_data,
+        'files': files,
+        'file_columns': {file: column for column, file in enumerate(files)},
+        'formulas_list': formulas_list,
+        'compound_groups': sorted(compound_groups),
+        'presence_matrices': presence_matrices,
+        # Files that could not be parsed, with the stat they failed at, so they are only retried once they change
+        'failed': failed or {},
+        # Serialized responses of this index version, filled on demand
+        'responses': {}
+    }
+
+# The current index; refresh_index replaces it as a whole, so a request always sees one consistent version
+index = build_index({}, {}, 0)
+index_lock = threading.Lock()
+
+# Reparse only the files that were added or changed since the last scan, and swap in a new index if anything changed
+def refresh_index():
+    global index
+    with index_lock:
+        current = index
+        file_stats = list_group_files()
+        if file_stats == {**current['file_stats'], **current['failed']}:
+            return current
+
+        file_data = {}
+        failed = {}
+        for file, stat in file_stats.items():
+            if current['file_stats'].get(file) == stat:
+                file_data[file] = current['file_data'][file]
+            elif current['failed'].get(file) == stat:
+                failed[file] = stat  # Still the same unparsable file, already reported
+            else:
+                try:
+                    file_data[file] = parse_file(os.path.join(directory, file))
+                except FileNotFoundError:
+                    continue  # Removed before it could be read; the next scan drops it
+                except (ValueError, OSError) as error:
+                    # Malformed line or not UTF-8 (UnicodeDecodeError is a ValueError): keep the last good parse, if any
+                    app.logger.warning(f"Could not parse {file}: {error}")
+                    if file in current['file_data']:
+                        file_data[file] = current['file_data'][file]
+                    else:
+                        failed[file] = stat
+        file_stats = {file: stat for file, stat in file_stats.items() if file in file_data}
+
+        index = build_index(file_stats, file_data, current['version'] + 1, failed)
+        return index
+
+# Poll the directory in the background so new and changed files show up without a restart
+def watch_directory():
+    while True:
+        time.sleep(POLL_INTERVAL)
+        try:
+            refresh_index()
+        except Exception:
+            # Never let one bad scan stop the watcher; the next poll tries again
+            app.logger.exception(f"Could not scan {directory}")
+
+refresh_index()
+threading.Thread(target=watch_directory, name='group-file-watcher', daemon=True).start()
+
+# Step 4: Files to compare: the ones the client asked for, else the n newest
+def select_files(current):
+    requested = {file for value in request.args.getlist('files') for file in value.split(',') if file}
+    if requested:
+        # Newest first and without repeats, so every selection maps to one cached response
+        return [file for file in current['files'] if file in requested]
+    n = request.args.get('n', DEFAULT_FILE_COUNT, type=int)
+    return current['files'][:max(n, 0)]
+
+# Step 5: Serialize and compress each response once per index version
+def cached_response(current, selected_group, selected_files):
+    key = (selected_group, tuple(selected_files))
+    if key not in current['responses']:
+        matrix = current['presence_matrices'].get(selected_group)
+        if matrix is None:
+            matrix = np.zeros((0, len(selected_files)), dtype=np.uint8)
+        else:
+            matrix = matrix[:, [current['file_columns'][file] for file in selected_files]]
+
+        # Formulas missing from the group in every selected file are never shown, so they are left out
+        present = np.flatnonzero(matrix.any(axis=1))
+        body = json.dumps({
+            'table_data': matrix[present].tolist(),
+            'formulas': [current['formulas_list'][row] for row in present],
+            'files': selected_files
+        }, separators=(',', ':')).encode('utf-8')
+        last_modified = max((current['file_stats'][file][0] for file in selected_files), default=0) / 1e9
+        current['responses'][key] = (body, gzip.compress(body), hashlib.sha1(body).hexdigest(), last_modified)
+    return current['responses'][key]
+
+# Send a cached JSON body, compressed when the client accepts it and answering revalidations with 304
+def json_response(body, compressed, etag, last_modified):
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response = Response(compressed, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+        etag += '-gzip'
+    else:
+        response = Response(body, mimetype='application/json')
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    return response.make_conditional(request)
 
 @app.route('/')
-def index():
-    return render_template('index.html', files=selected_files, groups=compound_groups)
+def index_page():
+    current = index
+    return render_template('index.html', files=current['files'][:DEFAULT_FILE_COUNT], groups=current['compound_groups'])
+
+@app.route('/files')
+def files():
+    current = index
+    body = json.dumps({
+        'files': [{'name': file, 'mtime': current['file_stats'][file][0] / 1e9} for file in current['files']],
+        'groups': current['compound_groups'],
+        'default_count': DEFAULT_FILE_COUNT
+    }, separators=(',', ':')).encode('utf-8')
+    last_modified = max((stat[0] for stat in current['file_stats'].values()), default=0) / 1e9
+    return json_response(body, gzip.compress(body), hashlib.sha1(body).hexdigest(), last_modified)
 
 @app.route('/data/<group>')
 def data(group):
-    table_data = generate_table_data(group)
-    return jsonify(table_data=table_data, formulas=formulas_list, files=selected_files)
+    current = index
+    return json_response(*cached_response(current, group, select_files(current)))
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    app.run(debug=True)